@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# Runs the whole anaxi pipeline (processTileParams -> downloadTiles -> stitchImages) against a local stand-in tile
+# server for a few area sizes, and prints one JSON line per run so results can be compared across commits.
+# Every run happens in its own process, in a fresh directory, so peak memory and bytes written are per run.
+#
+# With --shards N, the download is split between N anaxi --shard processes running at once, which are then merged
+# and stitched with --mergeShards, the way several machines sharing a tile store would.
+#
+# Usage: python benchmarks/bench_pipeline.py [--areas 4,16,32] [--format png] [--latency 20] [--concurrency 8]
+# Needs AnaxiMap installed (or src/ on PYTHONPATH) along with Pillow
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import anaximap
+from anaximap import tilenames
+from anaximap.tsdl import AnaxiPreferences, TileCollection, processTileParams
+
+from tileserver import TileServer
+
+START_TILE = (9912, 12119)  # Boston, at zoom 15
+
+
+def getCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def getPeakRssMB(who):
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def getBytesWritten(directory):
+    inodes = {}
+    for root, dirs, files in os.walk(directory):
+        for fileName in files:
+            fileStat = os.stat(os.path.join(root, fileName))
+            inodes[fileStat.st_ino] = fileStat.st_size  # Hardlinked tiles only count once
+    return sum(inodes.values())
+
+
+def getAreaCorners(side, zoom):
+    # processTileParams floors the start corner and ceils the end one, so use tile centres to get exactly side x side
+    startX, startY = START_TILE
+    latStart, lonStart = tilenames.xy2latlon(startX + 0.5, startY + 0.5, zoom)
+    latEnd, lonEnd = tilenames.xy2latlon(startX + side - 1.5, startY + side - 1.5, zoom)
+    return latStart, lonStart, latEnd, lonEnd
+
+
+def runShards(config, corners, workDir):
+    # Downloads with config["shards"] anaxi processes at once, returning their retries between them
+    metricsFiles = [os.path.join(workDir, "shard-%d.jsonl" % shard) for shard in range(1, config["shards"] + 1)]
+    # The shards run in workDir, so make sure they import the same anaximap, even from a relative PYTHONPATH
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(anaximap.__file__))),
+                                                       os.environ.get("PYTHONPATH", "")]))
+    shardProcesses = []
+    for shard, metricsFile in enumerate(metricsFiles, 1):
+        command = [sys.executable, "-m", "anaximap.tsdl"] + [str(corner) for corner in corners] + [
+            str(config["zoom"]), config["tileServer"], "--shard", "%d/%d" % (shard, config["shards"]),
+            "--concurrency", str(config["concurrency"]), "--tileStore", config["tileStore"], "--metricsFile", metricsFile]
+        shardProcesses.append(subprocess.Popen(command, cwd=workDir, env=env, stdout=subprocess.DEVNULL))
+
+    retries = 0
+    for shardProcess, metricsFile in zip(shardProcesses, metricsFiles):
+        if shardProcess.wait() != 0:
+            raise RuntimeError("shard process exited with %d" % shardProcess.returncode)
+        with open(metricsFile) as metricsLines:
+            retries += json.loads(metricsLines.read().splitlines()[-1])["counters"].get("retries", 0)
+        os.remove(metricsFile)
+    return retries
+
+
+def runOne(config):
+    # The child side: one pipeline run, timing the download and stitch phases as they happen
+    phases = {}
+    tileCounts = []
+
+    def timed(phase, method):
+        def timedMethod(self, *args, **kwargs):
+            tileCounts.append(len(self.tiles))
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                phases[phase] = phases.get(phase, 0) + time.perf_counter() - start
+        return timedMethod
+
+    TileCollection.downloadTiles = timed("download", TileCollection.downloadTiles)
+    TileCollection.stitchImages = timed("stitch", TileCollection.stitchImages)
+
+    metricsHandle, metricsFile = tempfile.mkstemp(prefix="anaxi-bench-", suffix=".jsonl")
+    os.close(metricsHandle)
+    corners = getAreaCorners(config["side"], config["zoom"])
+    prefs = AnaxiPreferences(*corners, config["zoom"], config["tileServer"],
+                             interactive=False, concurrency=config["concurrency"], tileStore=config["tileStore"],
+                             streamStitch=config["streamStitch"], stitchWorkers=config["stitchWorkers"],
+                             metricsFile=metricsFile, mergeShards=config["shards"] if config["shards"] > 1 else 0)
+
+    workDir = tempfile.mkdtemp(prefix="anaxi-bench-")
+    os.chdir(workDir)
+    start = time.perf_counter()
+    shardRetries = 0
+    try:
+        if prefs.mergeShards:
+            shardRetries = runShards(config, corners, workDir)
+            phases["download"] = time.perf_counter() - start
+        with open(os.devnull, "w") as devNull, contextlib.redirect_stdout(devNull):
+            err = processTileParams(prefs)
+        totalSeconds = time.perf_counter() - start
+        bytesWritten = getBytesWritten(workDir)
+        with open(metricsFile) as metricsLines:
+            summary = json.loads(metricsLines.read().splitlines()[-1])
+    finally:
+        os.chdir("/")
+        shutil.rmtree(workDir, ignore_errors=True)
+        os.remove(metricsFile)
+
+    tiles = tileCounts[0] if tileCounts else 0
+    megapixels = tiles * config["tileSize"] * config["tileSize"] / 1e6
+    downloadSeconds = phases.get("download", 0)
+    stitchSeconds = phases.get("stitch", 0)
+    return {
+        "err": err,
+        "tiles": tiles,
+        "totalSeconds": round(totalSeconds, 3),
+        "downloadSeconds": round(downloadSeconds, 3),
+        "tilesPerSecond": round(tiles / downloadSeconds, 1) if downloadSeconds else None,
+        "stitchSeconds": round(stitchSeconds, 3),
+        "stitchMegapixelsPerSecond": round(megapixels / stitchSeconds, 2) if stitchSeconds else None,
+        "peakRssMB": getPeakRssMB(resource.RUSAGE_SELF),
+        "workerPeakRssMB": getPeakRssMB(resource.RUSAGE_CHILDREN),
+        "bytesWritten": bytesWritten,
+        "retries": summary["counters"].get("retries", 0) + shardRetries,
+        "phases": summary["phases"],  # Seconds spent downloading, validating, decoding, pasting and encoding
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark downloading and stitching against a local tile server")
+    parser.add_argument('--areas', type=str, default="4,16,32", help="Comma separated sides (in tiles) of the square areas to run")
+    parser.add_argument('--zoom', type=int, default=15, help="Zoom level to download")
+    parser.add_argument('--format', choices=["png", "jpg"], default="png", help="Tile format to serve")
+    parser.add_argument('--tileSize', type=int, default=256, help="Width and height of the served tiles in pixels")
+    parser.add_argument('--latency', type=float, default=20, help="Milliseconds the server waits before every response")
+    parser.add_argument('--errorRate', type=float, default=0, help="Fraction of requests the server fails with a 503")
+    parser.add_argument('--concurrency', type=int, default=8, help="Passed to anaxi --concurrency")
+    parser.add_argument('--tileStore', choices=["files", "mbtiles"], default="files", help="Passed to anaxi --tileStore")
+    parser.add_argument('--streamStitch', action='store_true', help="Passed to anaxi --streamStitch")
+    parser.add_argument('--stitchWorkers', type=int, default=1, help="Passed to anaxi --stitchWorkers")
+    parser.add_argument('--shards', type=int, default=1, help="Download with this many anaxi --shard processes at once, then merge them")
+    parser.add_argument('--runOne', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.runOne:
+        print(json.dumps(runOne(json.loads(args.runOne))))
+        return
+
+    server = TileServer(latency=args.latency / 1000, tileSize=args.tileSize, errorRate=args.errorRate).start()
+    commit = getCommit()
+    try:
+        for side in [int(side) for side in args.areas.split(",")]:
+            config = {
+                "side": max(side, 2),
+                "zoom": args.zoom,
+                "tileServer": server.getURL("." + args.format),
+                "tileSize": args.tileSize,
+                "concurrency": args.concurrency,
+                "tileStore": args.tileStore,
+                "streamStitch": args.streamStitch,
+                "stitchWorkers": args.stitchWorkers,
+                "shards": args.shards,
+            }
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), "--runOne", json.dumps(config)],
+                                   capture_output=True, text=True)
+            if child.returncode != 0:
+                print(child.stderr, file=sys.stderr)
+                result = {"err": "crashed"}
+            else:
+                result = json.loads(child.stdout.strip().splitlines()[-1])
+
+            print(json.dumps(dict({
+                "benchmark": "pipeline",
+                "commit": commit,
+                "area": "%dx%d" % (config["side"], config["side"]),
+                "format": args.format,
+                "latencyMs": args.latency,
+                "errorRate": args.errorRate,
+                "concurrency": args.concurrency,
+                "tileStore": args.tileStore,
+                "streamStitch": args.streamStitch,
+                "stitchWorkers": args.stitchWorkers,
+                "shards": args.shards,
+            }, **result)), flush=True)
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
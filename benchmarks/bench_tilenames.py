@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# Compares the single point tilenames conversions (called in a Python loop) against their NumPy batch versions
+#
+# Usage: python benchmarks/bench_tilenames.py [--points 1000000] [--zoom 17]
+# Needs AnaxiMap installed (or src/ on PYTHONPATH) along with NumPy
+import argparse
+import json
+import random
+import time
+
+import numpy
+
+from anaximap import tilenames
+
+
+def timeIt(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scalar vs batch tilenames conversions")
+    parser.add_argument('--points', type=int, default=1000000, help="Number of points to convert")
+    parser.add_argument('--zoom', type=int, default=17, help="Zoom level to convert at")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for the generated points")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    lats = [random.uniform(-85, 85) for _ in range(args.points)]
+    lons = [random.uniform(-180, 180) for _ in range(args.points)]
+    latArray = numpy.array(lats)
+    lonArray = numpy.array(lons)
+    z = args.zoom
+
+    tileXs, tileYs = tilenames.tileXYBatch(latArray, lonArray, z)
+    xs = tileXs.tolist()
+    ys = tileYs.tolist()
+
+    cases = [
+        ("latlon2xy",
+         lambda: [tilenames.latlon2xy(lat, lon, z) for lat, lon in zip(lats, lons)],
+         lambda: tilenames.latlon2xyBatch(latArray, lonArray, z)),
+        ("xy2latlon",
+         lambda: [tilenames.xy2latlon(x, y, z) for x, y in zip(xs, ys)],
+         lambda: tilenames.xy2latlonBatch(tileXs, tileYs, z)),
+        ("tileEdges",
+         lambda: [tilenames.tileEdges(x, y, z) for x, y in zip(xs, ys)],
+         lambda: tilenames.tileEdgesBatch(tileXs, tileYs, z)),
+    ]
+
+    for name, scalarVersion, batchVersion in cases:
+        scalarSeconds, scalarResult = timeIt(scalarVersion)
+        batchSeconds, batchResult = timeIt(batchVersion)
+
+        # Make sure both versions agree before reporting how fast they are
+        maxDifference = float(numpy.max(numpy.abs(numpy.array(scalarResult).T - numpy.array(batchResult))))
+
+        print(json.dumps({
+            "benchmark": name,
+            "points": args.points,
+            "scalarSeconds": round(scalarSeconds, 4),
+            "batchSeconds": round(batchSeconds, 4),
+            "speedup": round(scalarSeconds / batchSeconds, 1) if batchSeconds else None,
+            "maxDifference": maxDifference,
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# A stand-in tile server for benchmarks, serving synthetic tiles at /{zoom}/{x}/{y}.png (or .jpg) with a configurable
+# latency, tile size and error rate, so download and stitch speed can be measured without touching a real server
+#
+# Usage: python benchmarks/tileserver.py [--port 8080] [--latency 20] [--tileSize 256] [--errorRate 0.01]
+import argparse
+import io
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+DISTINCT_TILES = 64  # Tiles are picked from a pool of pre-rendered images, so the server isn't the bottleneck
+
+
+def renderTiles(tileSize, imageFormat, seed=0):
+    # Noisy gradients, so tiles compress about as well as real map tiles rather than to almost nothing
+    rng = random.Random(seed)
+    tiles = []
+    for i in range(DISTINCT_TILES):
+        base = Image.linear_gradient("L").resize((tileSize, tileSize)).rotate(rng.randrange(360))
+        noise = Image.effect_noise((tileSize, tileSize), 8 + i % 8)
+        image = Image.merge("RGB", (base, noise, Image.blend(base, noise, 0.5)))
+        if imageFormat == "PNG":
+            image = image.quantize(32).convert("RGB")  # Map tiles tend to have few colors
+        tileData = io.BytesIO()
+        image.save(tileData, imageFormat)
+        tiles.append(tileData.getvalue())
+    return tiles
+
+
+class TileServer:
+    def __init__(self, port=0, latency=0.0, tileSize=256, errorRate=0.0, seed=0):
+        self.latency = latency  # Seconds added to every response
+        self.errorRate = errorRate  # Fraction of requests answered with a 503
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.tiles = {".png": renderTiles(tileSize, "PNG", seed), ".jpg": renderTiles(tileSize, "JPEG", seed)}
+        self.httpServer = ThreadingHTTPServer(("127.0.0.1", port), self.makeHandler())
+        self.httpServer.daemon_threads = True
+        self.port = self.httpServer.server_address[1]
+        self.thread = None
+
+    def getURL(self, extension=".png"):
+        return "http://127.0.0.1:%d/%%zoom%%/%%xTile%%/%%yTile%%%s" % (self.port, extension)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpServer.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+
+    def makeHandler(self):
+        server = self
+
+        class TileRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                    failed = server.random.random() < server.errorRate
+                    if failed:
+                        server.errors += 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+                try:
+                    zoom, x, yAndExtension = self.path.split("?")[0].strip("/").split("/")[-3:]
+                    y, extension = yAndExtension.split(".")
+                    tiles = server.tiles["." + extension]
+                    tileData = tiles[(int(x) * 31 + int(y) * 17 + int(zoom)) % len(tiles)]
+                except (ValueError, KeyError):
+                    self.send(404, b"")
+                    return
+
+                if failed:
+                    self.send(503, b"", {"Retry-After": "0"})
+                    return
+                self.send(200, tileData, {"Content-Type": "image/jpeg" if extension == "jpg" else "image/png"})
+
+            def send(self, statusCode, body, headers=None):
+                self.send_response(statusCode)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return TileRequestHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic map tiles for benchmarking")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on")
+    parser.add_argument('--latency', type=float, default=0, help="Milliseconds to wait before every response")
+    parser.add_argument('--tileSize', type=int, default=256, help="Width and height of the tiles in pixels")
+    parser.add_argument('--errorRate', type=float, default=0, help="Fraction of requests to fail with a 503")
+    args = parser.parse_args()
+
+    server = TileServer(args.port, args.latency / 1000, args.tileSize, args.errorRate)
+    print("Serving tiles at", server.getURL(), "and", server.getURL(".jpg"))
+    try:
+        server.httpServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# `anaxi batch`: makes many Maps from a list of jobs, downloading the tiles they share only once. Jobs are grouped by
+# tile server and zoom, each group's tiles (the union of its jobs' areas) are downloaded into one shared cache, and
+# then every job's Map is stitched from that cache, several at a time.
+#
+# The jobs file is JSON, either a list of jobs or an object with a "jobs" list whose other keys are defaults for
+# every job:
+#
+#   {"tileServer": "https://tile.openstreetmap.org/%zoom%/%xTile%/%yTile%.png", "zoom": 15, "jobs": [
+#       {"bbox": [42.3635, -71.0963, 42.3541, -71.0697], "output": "maps/cambridge.png"},
+#       {"bbox": [42.3601, -71.0712, 42.3489, -71.0511], "output": "maps/boston.tif", "geotiff": true}
+#   ]}
+#
+# bbox is latStart, lonStart, latEnd, lonEnd like anaxi's arguments. Jobs may also have an "area" GeoJSON file, a
+# "backgroundColor", "scale" and "maxPixels", like the options of the same names. Maps are saved as output, in its
+# format (the tiles' format if it has no extension), next to an info file.
+import argparse
+import inspect
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import polygon, tilestore
+from .manifest import TileManifest
+from .metrics import Metrics
+from .scheduler import READ_TIMEOUT
+from .tsdl import TileCollection, genInfoFile, getTileBounds, parseColor, parseMaxPixels, parseScale, resolveTileServer
+
+JOB_KEYS = ("bbox", "zoom", "tileServer", "output")
+
+
+class BatchJob:
+    def __init__(self, bbox, zoom, tileServer, output, area=None, backgroundColor=None, geotiff=False, scale=1.0, maxPixels=0):
+        self.zoom = int(zoom)
+        self.tileServer = tileServer
+        self.output = output
+        self.backgroundColor = backgroundColor
+        self.geotiff = geotiff
+        self.scale = parseScale(scale)
+        self.maxPixels = parseMaxPixels(maxPixels)
+
+        tileStartX, tileStartY, tileEndX, tileEndY = getTileBounds(*bbox, self.zoom)
+        if area:
+            self.cover = polygon.coverGeoJSON(polygon.loadGeoJSON(area), self.zoom).clip(tileStartX, tileStartY, tileEndX, tileEndY)
+        else:
+            self.cover = polygon.TileCover({y: [(tileStartX, tileEndX)] for y in range(tileStartY, tileEndY + 1)})
+
+    def makeCollection(self, groupCol):
+        # This job's part of its group's tiles, sharing the group's store and manifest
+        name, stitchFormat = os.path.splitext(self.output)
+        tileStartX, tileStartY, tileEndX, tileEndY = self.cover.getBounds()
+        jobCol = TileCollection(tileStartX, tileStartY, tileEndX, tileEndY, self.zoom, self.tileServer, name,
+                                groupCol.store, groupCol.manifest, self.cover, Metrics(verbose=groupCol.metrics.verbose, progress=False))
+        jobCol.tileExtension = groupCol.tileExtension
+        jobCol.session = groupCol.session
+        jobCol.scheduler = groupCol.scheduler
+        return jobCol, stitchFormat
+
+
+def loadJobs(fileName):
+    # Returns a list of BatchJobs, or None if the file has a problem (which is printed)
+    try:
+        with open(fileName) as jobsFile:
+            jobsData = json.load(jobsFile)
+    except (OSError, ValueError) as e:
+        print("ERROR: Could not read jobs from", fileName + ":", e)
+        return None
+
+    defaults = {}
+    if isinstance(jobsData, dict):
+        defaults = {key: value for key, value in jobsData.items() if key != "jobs"}
+        jobsData = jobsData.get("jobs", [])
+
+    jobs = []
+    for i, jobData in enumerate(jobsData):
+        jobData = dict(defaults, **jobData)
+        missing = [key for key in JOB_KEYS if key not in jobData]
+        if missing:
+            print("ERROR: Job", i, "in", fileName, "is missing", ", ".join(missing))
+            return None
+        unknown = [key for key in jobData if key not in inspect.signature(BatchJob).parameters]
+        if unknown:
+            print("ERROR: Job", i, "in", fileName, "has unknown keys", ", ".join(unknown))
+            return None
+        if jobData.get("backgroundColor") is not None:
+            try:
+                parseColor(jobData["backgroundColor"])
+            except argparse.ArgumentTypeError as e:
+                print("ERROR: Job", i, "in", fileName, "has an unknown backgroundColor:", e)
+                return None
+        jobData["tileServer"] = resolveTileServer(str(jobData["tileServer"]))
+        try:
+            job = BatchJob(**jobData)
+        except argparse.ArgumentTypeError as e:
+            print("ERROR: Job", i, "in", fileName, "is invalid,", e)
+            return None
+        except (TypeError, ValueError, KeyError, AttributeError) as e:
+            print("ERROR: Job", i, "in", fileName, "is invalid, bbox must be 4 numbers, zoom an integer and area a GeoJSON "
+                  "file of Polygons (" + repr(e) + ")")
+            return None
+        except OSError as e:
+            print("ERROR: Could not read the area of job", i, "in", fileName + ":", e)
+            return None
+        if not job.cover:
+            print("ERROR: The area of job", i, "in", fileName, "doesn't touch any tiles between its corners")
+            return None
+        jobs.append(job)
+    return jobs
+
+
+def openServerCache(cacheDir, tileServer, args):
+    # The store and manifest of one tile server's tiles, shared by every zoom
+    serverDir = os.path.join(cacheDir, tilestore.getServerKey(tileServer))
+    os.makedirs(serverDir, exist_ok=True)
+    if args.cacheDir:
+        # Trimmed once every Map is stitched, a later group's flush mustn't evict tiles an earlier group's Maps need
+        store = tilestore.CacheTileStore(args.cacheDir, tileServer, args.cacheMaxSize * 1024 * 1024, args.dedup, evictOnFlush=False)
+    elif args.tileStore == "mbtiles":
+        store = tilestore.MBTilesTileStore(os.path.join(serverDir, "tiles.mbtiles"), os.path.basename(serverDir), dedup=args.dedup)
+    else:
+        store = tilestore.FileTileStore(serverDir, args.dedup)
+    return store, TileManifest(os.path.join(serverDir, "manifest.json"))
+
+
+def getGroupCover(groupJobs):
+    # Every tile any of the jobs needs, once
+    cover = polygon.TileCover()
+    for job in groupJobs:
+        cover.union(job.cover)
+    return cover
+
+
+def downloadGroup(groupJobs, cover, serverCache, args, metrics):
+    # Returns the group's TileCollection and the download's error code
+    tileServer, zoom = groupJobs[0].tileServer, groupJobs[0].zoom
+    store, manifest = serverCache
+    tileStartX, tileStartY, tileEndX, tileEndY = cover.getBounds()
+    groupCol = TileCollection(tileStartX, tileStartY, tileEndX, tileEndY, zoom, tileServer, "tiles", store, manifest,
+                              cover, metrics)
+    downloadErr = groupCol.downloadTiles(args.forceDownload, args.concurrency, args.hostConcurrency, rateLimit=args.rateLimit,
+                                         retries=args.retries, timeout=args.timeout)
+    if downloadErr == 0:
+        # Checking (and repairing) shared tiles once here, stops the stitch jobs all redownloading them at the same time
+        groupCol.scanTiles()
+    return groupCol, downloadErr
+
+
+def stitchJob(job, groupCol, args):
+    jobCol, stitchFormat = job.makeCollection(groupCol)
+    outputDir = os.path.dirname(job.output)
+    if outputDir:
+        os.makedirs(outputDir, exist_ok=True)
+
+    stitchResult = jobCol.stitchImages(stitchFormat, args.streamStitch, args.stitchWorkers, job.backgroundColor, job.geotiff,
+                                       job.scale, job.maxPixels)
+    if stitchResult["err"] == 0:
+        genInfoFile(jobCol)
+    return stitchResult["err"], jobCol.metrics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="anaxi batch", description="Make many Maps, downloading the tiles they share only once")
+    parser.add_argument('jobs', type=str, help="JSON file listing the Maps to make")
+    parser.add_argument('--name', type=str, default="batch", help="Where to keep the shared tile cache")
+    parser.add_argument('--forceDownload', action='store_true', help="Skip checking if files are already downloaded")
+    parser.add_argument('--dryRun', action='store_true', help="Print how many tiles the jobs need and exit")
+    parser.add_argument('--concurrency', type=int, default=8, help="Number of tiles to download at once")
+    parser.add_argument('--hostConcurrency', type=int, default=0, help="Max concurrent downloads per tile server host (default: same as --concurrency)")
+    parser.add_argument('--rateLimit', type=float, default=0, help="Max requests per second to each host")
+    parser.add_argument('--retries', type=int, default=3, help="Times to retry a tile after a throttled / failed request")
+    parser.add_argument('--timeout', type=float, default=READ_TIMEOUT, help="Seconds a tile request may stall for before it's retried")
+    parser.add_argument('--tileStore', choices=["files", "mbtiles"], default="files", help="Keep tiles as loose files, or in a single MBTiles (SQLite) database per server")
+    parser.add_argument('--dedup', action='store_true', help="Store identical tiles only once")
+    parser.add_argument('--cacheDir', type=str, default=None, help="Keep tiles in this cache directory shared with other runs, instead of <name>/raw")
+    parser.add_argument('--cacheMaxSize', type=int, default=0, help="MB the shared cache may grow to before the least recently used tiles are evicted (default: unlimited)")
+    parser.add_argument('--stitchJobs', type=int, default=4, help="Number of Maps to stitch at once")
+    parser.add_argument('--streamStitch', action='store_true', help="Stitch one row of tiles at a time to limit memory use (PNG / TIFF output only)")
+    parser.add_argument('--stitchWorkers', type=int, default=1, help="Number of processes each Map decodes tiles with while stitching")
+    parser.add_argument('--verbose', action='store_true', help="Print a line for every tile instead of a progress bar")
+    parser.add_argument('--metricsFile', type=str, default=None, help="Append timings and counts for the run to this file as JSON Lines")
+    parser.add_argument('--prometheusFile', type=str, default=None, help="Keep a Prometheus textfile with the run's metrics up to date here")
+    args = parser.parse_args(argv)
+
+    jobs = loadJobs(args.jobs)
+    if jobs is None:
+        return 1
+
+    groups = {}
+    for job in jobs:
+        groups.setdefault((job.tileServer, job.zoom), []).append(job)
+    print(len(jobs), "maps from", len(groups), "tile server / zoom combinations")
+
+    groupCovers = {}
+    for (tileServer, zoom), groupJobs in groups.items():
+        groupCovers[tileServer, zoom] = getGroupCover(groupJobs)
+        print("Zoom", zoom, "from", tileServer + ":", len(groupJobs), "maps need", len(groupCovers[tileServer, zoom]),
+              "unique tiles,", sum(len(job.cover) for job in groupJobs), "in total")
+
+    if args.dryRun:
+        print("Dry run, exiting now...")
+        return 0
+
+    metrics = Metrics(args.metricsFile, args.prometheusFile, args.verbose)
+    cacheDir = os.path.join(args.name, "raw")
+    err = 0
+    serverCaches = {}
+    stitches = []  # (job, its group's TileCollection)
+    try:
+        for (tileServer, zoom), groupJobs in groups.items():
+            if tileServer not in serverCaches:
+                serverCaches[tileServer] = openServerCache(cacheDir, tileServer, args)
+            groupCol, downloadErr = downloadGroup(groupJobs, groupCovers[tileServer, zoom], serverCaches[tileServer], args, metrics)
+            if downloadErr != 0:
+                print("ERROR: Not all tiles for zoom", groupCol.zoom, "from", groupCol.tileServer, "could be downloaded, skipping its",
+                      len(groupJobs), "maps")
+                err = err or downloadErr
+                continue
+            stitches += [(job, groupCol) for job in groupJobs]
+        metrics.printSummary()
+
+        # Stitch jobs share their group's store and manifest, which are safe to use from several threads
+        with metrics.phase("stitch"), ThreadPoolExecutor(max_workers=max(args.stitchJobs, 1)) as executor:
+            metrics.startProgress("Stitching maps", len(stitches))
+            results = executor.map(lambda stitch: stitchJob(stitch[0], stitch[1], args), stitches)
+            for (job, _), (stitchErr, jobMetrics) in zip(stitches, results):
+                for phase, seconds in jobMetrics.phases.items():
+                    metrics.addTime(phase, seconds)
+                for name, value in jobMetrics.counters.items():
+                    metrics.increment(name, value)
+                if stitchErr != 0:
+                    print("ERROR: Could not stitch", job.output)
+                    err = err or stitchErr
+                else:
+                    metrics.increment("mapsStitched")
+                metrics.advance()
+            metrics.finishProgress()
+    finally:
+        for store, manifest in serverCaches.values():
+            manifest.save()
+            store.close()
+        metrics.close()
+
+    print("Made", metrics.counters["mapsStitched"], "of", len(jobs), "maps")
+    return err
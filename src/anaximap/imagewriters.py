@@ -0,0 +1,365 @@
+# Minimal PNG and TIFF encoders that accept an image a horizontal strip at a time, so a stitched Map never has to
+# exist in memory all at once. Only 8-bit RGB and RGBA images are supported, which is all the stitcher produces.
+import os
+import shutil
+import struct
+import zlib
+
+from PIL import Image, ImageChops
+
+
+def horizontalDifference(strip):
+    # Each byte minus the same channel of the pixel to its left. This is PNG's "Sub" filter and TIFF's
+    # horizontal predictor, and lets zlib compress map imagery far better than raw pixels
+    shifted = Image.new(strip.mode, strip.size)
+    shifted.paste(strip.crop((0, 0, strip.size[0] - 1, strip.size[1])), (1, 0))
+    return ImageChops.subtract_modulo(strip, shifted)
+
+
+class PngStripWriter:
+    # https://www.w3.org/TR/png/
+    def __init__(self, fileName, width, height, mode):
+        if mode not in ("RGB", "RGBA"):
+            raise ValueError("Unsupported image mode for PNG streaming: " + mode)
+
+        self.rowBytes = width * len(mode)
+        self.compressor = zlib.compressobj(6)
+        self.file = open(fileName, 'wb')
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.__writeChunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6 if mode == "RGBA" else 2, 0, 0, 0))
+
+    def writeStrip(self, strip):
+        filtered = horizontalDifference(strip).tobytes()
+        scanlines = bytearray()
+        for rowStart in range(0, len(filtered), self.rowBytes):
+            scanlines.append(1)  # Filter type 1 (Sub) for every scanline
+            scanlines += filtered[rowStart:rowStart + self.rowBytes]
+
+        compressed = self.compressor.compress(bytes(scanlines))
+        if compressed:
+            self.__writeChunk(b"IDAT", compressed)
+
+    def close(self):
+        self.__writeChunk(b"IDAT", self.compressor.flush())
+        self.__writeChunk(b"IEND", b"")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __writeChunk(self, chunkType, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunkType)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(chunkType + data)))
+
+
+# TIFF field types, and the tags used below. See https://www.itu.int/itudoc/itu-t/com16/tiff-fx/docs/tiff6.pdf
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_DOUBLE = 12
+TIFF_LONG8 = 16  # BigTIFF only
+TIFF_TYPE_FORMATS = {TIFF_SHORT: "H", TIFF_LONG: "I", TIFF_DOUBLE: "d", TIFF_LONG8: "Q"}
+MAX_TIFF_OFFSET = 0xFFFFFFFF  # Files with anything past this need BigTIFF's 64-bit offsets
+
+TAG_NEW_SUBFILE_TYPE = 254
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_PLANAR_CONFIG = 284
+TAG_PREDICTOR = 317
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+TAG_EXTRA_SAMPLES = 338
+
+# GeoTIFF tags and keys, see http://docs.opengeospatial.org/is/19-008r4/19-008r4.html
+TAG_MODEL_PIXEL_SCALE = 33550
+TAG_MODEL_TIEPOINT = 33922
+TAG_GEO_KEY_DIRECTORY = 34735
+GEO_KEY_MODEL_TYPE = 1024
+GEO_KEY_RASTER_TYPE = 1025
+GEO_KEY_PROJECTED_CRS = 3072
+GEO_KEY_PROJECTED_LINEAR_UNITS = 3076
+
+COMPRESSION_DEFLATE = 8
+PREDICTOR_HORIZONTAL = 2
+SUBFILE_REDUCED_IMAGE = 1
+GEOTIFF_TILE_SIZE = 256  # Pixels, must be a multiple of 16
+
+
+def getTiffImageTags(width, height, mode):
+    # Tags shared by every RGB(A), deflate-compressed, horizontally-predicted image
+    samplesPerPixel = len(mode)
+    tags = [
+        (TAG_IMAGE_WIDTH, TIFF_LONG, [width]),
+        (TAG_IMAGE_LENGTH, TIFF_LONG, [height]),
+        (TAG_BITS_PER_SAMPLE, TIFF_SHORT, [8] * samplesPerPixel),
+        (TAG_COMPRESSION, TIFF_SHORT, [COMPRESSION_DEFLATE]),
+        (TAG_PHOTOMETRIC, TIFF_SHORT, [2]),  # RGB
+        (TAG_SAMPLES_PER_PIXEL, TIFF_SHORT, [samplesPerPixel]),
+        (TAG_PLANAR_CONFIG, TIFF_SHORT, [1]),  # Chunky, RGBRGB...
+        (TAG_PREDICTOR, TIFF_SHORT, [PREDICTOR_HORIZONTAL]),
+    ]
+    if mode == "RGBA":
+        tags.append((TAG_EXTRA_SAMPLES, TIFF_SHORT, [2]))  # Unassociated alpha
+    return tags
+
+
+def packTiffHeader(ifdOffset, bigTiff=False):
+    # Always 16 bytes, the end of a classic TIFF's 8 byte header is padded
+    if bigTiff:
+        return b"II+\x00" + struct.pack("<HHQ", 8, 0, ifdOffset)  # https://www.awaresystems.be/imaging/tiff/bigtiff.html
+    return b"II*\x00" + struct.pack("<I", ifdOffset) + b"\x00" * 8
+
+
+def packTiffIfd(tags, ifdOffset, nextIfdOffset=0, bigTiff=False):
+    # Lays out one little-endian Image File Directory at ifdOffset, with any values too large to fit inline
+    # stored straight after it. Returns the bytes to write there. BigTIFF directories have 8 byte counts, offsets
+    # and inline values
+    countFormat, entryFormat, offsetFormat = ("<Q", "<HHQ", "Q") if bigTiff else ("<H", "<HHI", "I")
+    inlineSize = struct.calcsize(offsetFormat)
+    tags = sorted(tags, key=lambda tag: tag[0])
+    extraOffset = ifdOffset + struct.calcsize(countFormat) + len(tags) * (struct.calcsize(entryFormat) + inlineSize) + inlineSize
+    entries = struct.pack(countFormat, len(tags))
+    extra = b""
+    for tag, fieldType, values in tags:
+        packedValues = struct.pack("<%d%s" % (len(values), TIFF_TYPE_FORMATS[fieldType]), *values)
+        if len(packedValues) <= inlineSize:
+            entries += struct.pack(entryFormat, tag, fieldType, len(values)) + packedValues.ljust(inlineSize, b"\x00")
+        else:
+            if len(extra) % 2:
+                extra += b"\x00"  # Values must start on a word boundary
+            entries += struct.pack(entryFormat + offsetFormat, tag, fieldType, len(values), extraOffset + len(extra))
+            extra += packedValues
+
+    return entries + struct.pack("<" + offsetFormat, nextIfdOffset) + extra
+
+
+class TiffStripWriter:
+    # A single-image TIFF made of deflate-compressed strips. The directory is written once every strip is known,
+    # at the end of the file, with the header pointing to it. Files that end up over 4GB are written as BigTIFF
+    def __init__(self, fileName, width, height, mode):
+        if mode not in ("RGB", "RGBA"):
+            raise ValueError("Unsupported image mode for TIFF streaming: " + mode)
+
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.rowsPerStrip = None
+        self.stripOffsets = []
+        self.stripByteCounts = []
+        self.file = open(fileName, 'wb')
+        self.file.write(packTiffHeader(0))  # Filled in by close(), once we know if it's a BigTIFF
+
+    def writeStrip(self, strip):
+        if self.rowsPerStrip is None:
+            self.rowsPerStrip = strip.size[1]
+
+        compressed = zlib.compress(horizontalDifference(strip).tobytes(), 6)
+        self.stripOffsets.append(self.file.tell())
+        self.stripByteCounts.append(len(compressed))
+        self.file.write(compressed)
+
+    def close(self):
+        if self.file.tell() % 2:
+            self.file.write(b"\x00")
+        ifdOffset = self.file.tell()
+
+        bigTiff = ifdOffset > MAX_TIFF_OFFSET or ifdOffset + len(packTiffIfd(self.__getTags(TIFF_LONG), 0)) > MAX_TIFF_OFFSET
+        self.file.write(packTiffIfd(self.__getTags(TIFF_LONG8 if bigTiff else TIFF_LONG), ifdOffset, bigTiff=bigTiff))
+        self.file.seek(0)
+        self.file.write(packTiffHeader(ifdOffset, bigTiff))
+        self.file.close()
+
+    def __getTags(self, offsetType):
+        return getTiffImageTags(self.width, self.height, self.mode) + [
+            (TAG_ROWS_PER_STRIP, TIFF_LONG, [self.rowsPerStrip or self.height]),
+            (TAG_STRIP_OFFSETS, offsetType, self.stripOffsets),
+            (TAG_STRIP_BYTE_COUNTS, TIFF_LONG, self.stripByteCounts),
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def getGeoTiffTags(width, height, bounds):
+    # Places the image's corners at bounds, (west, south, east, north) in Web Mercator meters (EPSG:3857)
+    west, south, east, north = bounds
+    return [
+        (TAG_MODEL_PIXEL_SCALE, TIFF_DOUBLE, [(east - west) / width, (north - south) / height, 0.0]),
+        (TAG_MODEL_TIEPOINT, TIFF_DOUBLE, [0.0, 0.0, 0.0, west, north, 0.0]),  # Top left pixel's corner
+        (TAG_GEO_KEY_DIRECTORY, TIFF_SHORT, [
+            1, 1, 0, 4,  # Version 1.1.0, 4 keys
+            GEO_KEY_MODEL_TYPE, 0, 1, 1,  # Projected
+            GEO_KEY_RASTER_TYPE, 0, 1, 1,  # Pixels are areas
+            GEO_KEY_PROJECTED_CRS, 0, 1, 3857,
+            GEO_KEY_PROJECTED_LINEAR_UNITS, 0, 1, 9001,  # Meters
+        ]),
+    ]
+
+
+def reduceByHalf(image):
+    # Premultiplying stops transparent pixels bleeding black into their neighbours
+    if image.mode == "RGBA":
+        return image.convert("RGBa").reduce(2).convert("RGBA")
+    return image.reduce(2)
+
+
+class TiledLevel:
+    # One resolution of a tiled TIFF. Rows of pixels are cut into square tiles as they arrive and compressed into a
+    # scratch file, and each finished row of tiles is scaled down by half and handed to the next (overview) level
+    def __init__(self, fileName, width, height, mode, tileSize, level=0):
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.tileSize = tileSize
+        self.fileName = "%s.%d.tmp" % (fileName, level)
+        self.file = open(self.fileName, 'w+b')
+        self.tileByteCounts = []
+        self.pending = None  # Rows not yet cut into tiles
+        self.overview = None
+        if width > tileSize or height > tileSize:
+            self.overview = TiledLevel(fileName, (width + 1) // 2, (height + 1) // 2, mode, tileSize, level + 1)
+
+    def addRows(self, rows):
+        if self.pending is not None:
+            joined = Image.new(self.mode, (self.width, self.pending.size[1] + rows.size[1]))
+            joined.paste(self.pending, (0, 0))
+            joined.paste(rows, (0, self.pending.size[1]))
+            rows = joined
+
+        while rows is not None and rows.size[1] >= self.tileSize:
+            self.__writeTileRow(rows.crop((0, 0, self.width, self.tileSize)))
+            rows = rows.crop((0, self.tileSize, self.width, rows.size[1])) if rows.size[1] > self.tileSize else None
+        self.pending = rows
+
+    def __writeTileRow(self, rows):
+        for x in range(0, self.width, self.tileSize):
+            # Tiles are always full size, those over the right / bottom edges are padded
+            tile = Image.new(self.mode, (self.tileSize, self.tileSize))
+            tile.paste(rows.crop((x, 0, min(x + self.tileSize, self.width), rows.size[1])), (0, 0))
+            compressed = zlib.compress(horizontalDifference(tile).tobytes(), 6)
+            self.file.write(compressed)
+            self.tileByteCounts.append(len(compressed))
+
+        if self.overview is not None:
+            self.overview.addRows(reduceByHalf(rows))
+
+    def finish(self):
+        if self.pending is not None:
+            self.__writeTileRow(self.pending)
+            self.pending = None
+        if self.overview is not None:
+            self.overview.finish()
+
+    def getLevels(self):
+        return [self] + (self.overview.getLevels() if self.overview is not None else [])
+
+    def getTags(self, dataOffset, offsetType=TIFF_LONG):
+        tileOffsets = []
+        for byteCount in self.tileByteCounts:
+            tileOffsets.append(dataOffset)
+            dataOffset += byteCount
+        return getTiffImageTags(self.width, self.height, self.mode) + [
+            (TAG_TILE_WIDTH, TIFF_LONG, [self.tileSize]),
+            (TAG_TILE_LENGTH, TIFF_LONG, [self.tileSize]),
+            (TAG_TILE_OFFSETS, offsetType, tileOffsets),
+            (TAG_TILE_BYTE_COUNTS, TIFF_LONG, self.tileByteCounts),
+        ]
+
+    def copyTo(self, file):
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, file)
+
+    def close(self):
+        self.file.close()
+        os.remove(self.fileName)
+
+
+class GeoTiffStripWriter:
+    # A Cloud Optimized GeoTIFF: georeferenced, tiled and compressed, with overviews halving in size down to a single
+    # tile, so GIS tools can read any window or zoomed out view without decoding the whole Map
+    # https://github.com/cogeotiff/cog-spec/blob/master/spec.md
+    # Every level is tiled into its own scratch file while strips arrive, and close() lays out the final file with
+    # all the directories first, then the tiles from the smallest overview to the full resolution image. Files over
+    # 4GB are written as BigTIFF
+    def __init__(self, fileName, width, height, mode, bounds=None, tileSize=GEOTIFF_TILE_SIZE):
+        if mode not in ("RGB", "RGBA"):
+            raise ValueError("Unsupported image mode for GeoTIFF: " + mode)
+
+        self.fileName = fileName
+        self.width = width
+        self.height = height
+        self.bounds = bounds
+        self.fullLevel = TiledLevel(fileName, width, height, mode, tileSize)
+
+    def writeStrip(self, strip):
+        self.fullLevel.addRows(strip)
+
+    def close(self):
+        self.fullLevel.finish()
+        levels = self.fullLevel.getLevels()
+        try:
+            self.__writeFile(levels)
+        finally:
+            for level in levels:
+                level.close()
+
+    def __writeFile(self, levels):
+        # The directories' sizes don't depend on the offsets in them, so they can be measured with placeholders
+        for bigTiff in (False, True):
+            ifdOffsets = []
+            offset = len(packTiffHeader(0))
+            for level in levels:
+                ifdOffsets.append(offset)
+                offset += len(packTiffIfd(self.__getTags(level, 0, bigTiff), 0, bigTiff=bigTiff))
+
+            dataOffsets = {}
+            for level in reversed(levels):
+                dataOffsets[level] = offset
+                offset += sum(level.tileByteCounts)
+            if offset <= MAX_TIFF_OFFSET:
+                break
+
+        with open(self.fileName, 'wb') as file:
+            file.write(packTiffHeader(ifdOffsets[0], bigTiff))
+            for i, level in enumerate(levels):
+                nextIfdOffset = ifdOffsets[i + 1] if i + 1 < len(levels) else 0
+                file.write(packTiffIfd(self.__getTags(level, dataOffsets[level], bigTiff), ifdOffsets[i], nextIfdOffset, bigTiff))
+            for level in reversed(levels):
+                level.copyTo(file)
+
+    def __getTags(self, level, dataOffset, bigTiff=False):
+        tags = level.getTags(dataOffset, TIFF_LONG8 if bigTiff else TIFF_LONG)
+        if level is not self.fullLevel:
+            tags.append((TAG_NEW_SUBFILE_TYPE, TIFF_LONG, [SUBFILE_REDUCED_IMAGE]))
+        elif self.bounds is not None:
+            tags += getGeoTiffTags(self.width, self.height, self.bounds)
+        return tags
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+STRIP_WRITERS = {
+    ".png": PngStripWriter,
+    ".tif": TiffStripWriter,
+    ".tiff": TiffStripWriter,
+}
@@ -0,0 +1,155 @@
+# An append-only record of a download job, so very large jobs can be stopped and resumed without walking (and
+# stat'ing) the whole area again. The journal starts with the job's plan, followed by one line per finished tile
+# with its status code. Every so often the tiles still left to download are snapshotted into a checkpoint and the
+# journal starts over, so resuming only needs the checkpoint plus the lines written after it.
+import array
+import json
+import os
+import threading
+
+
+def getPlan(tileCollection):
+    # Identifies a job, a journal from a different job is never resumed
+    return {
+        "tileServer": tileCollection.tileServer,
+        "zoom": tileCollection.zoom,
+        "tileStartX": tileCollection.tileStartX,
+        "tileStartY": tileCollection.tileStartY,
+        "tileEndX": tileCollection.tileEndX,
+        "tileEndY": tileCollection.tileEndY,
+        "numTiles": len(tileCollection.tiles),
+    }
+
+
+class DownloadJournal:
+    def __init__(self, fileName="download.journal", checkpointEvery=1000):
+        self.fileName = fileName
+        self.checkpointFileName = os.path.splitext(fileName)[0] + ".checkpoint"
+        self.checkpointEvery = checkpointEvery
+        self.lock = threading.Lock()
+        self.plan = None
+        self.pending = array.array('q')  # Flattened x, y pairs of tiles not yet downloaded, in download order
+        self.done = set()  # Tiles finished since the last checkpoint
+        self.failed = {}  # (x, y) of tiles whose last attempt failed, to their status code
+        self.journalFile = None
+        self.sinceCheckpoint = 0
+
+    def open(self, tileCollection, restart=False):
+        # Returns True if an earlier, unfinished run of the same job was picked back up
+        self.plan = getPlan(tileCollection)
+        resumed = not restart and self.__load(tileCollection)
+        if not resumed:
+            self.pending = array.array('q', getTileCoords(tileCollection.tiles))
+            self.done = set()
+            self.failed = {}
+
+        with self.lock:
+            self.__checkpoint()
+        return resumed
+
+    def getPendingTiles(self):
+        # (x, y) of every tile not downloaded yet, including ones that failed before
+        with self.lock:
+            return [(self.pending[i], self.pending[i + 1]) for i in range(0, len(self.pending), 2)
+                    if (self.pending[i], self.pending[i + 1]) not in self.done]
+
+    def getFailedTiles(self):
+        with self.lock:
+            return list(self.failed)
+
+    def record(self, tile, statusCode):
+        key = (tile.tileX, tile.tileY)
+        with self.lock:
+            if statusCode == 200:
+                self.done.add(key)
+                self.failed.pop(key, None)
+            else:
+                self.failed[key] = statusCode
+
+            self.journalFile.write(json.dumps({"x": tile.tileX, "y": tile.tileY, "status": "done" if statusCode == 200 else "failed", "code": statusCode}) + "\n")
+            self.journalFile.flush()
+
+            # Checkpoints cost a pass over the pending tiles, so huge jobs checkpoint proportionally less often
+            self.sinceCheckpoint += 1
+            if self.sinceCheckpoint >= max(self.checkpointEvery, len(self.pending) // 40):
+                self.__checkpoint()
+
+    def close(self):
+        with self.lock:
+            self.__checkpoint()
+            self.journalFile.close()
+            self.journalFile = None
+
+    def __load(self, tileCollection):
+        checkpoint = None
+        if os.path.isfile(self.checkpointFileName):
+            try:
+                with open(self.checkpointFileName) as checkpointFile:
+                    checkpoint = json.load(checkpointFile)
+            except ValueError:
+                checkpoint = None
+            if checkpoint is not None and checkpoint.get("plan") != self.plan:
+                checkpoint = None
+
+        entries = []
+        if os.path.isfile(self.fileName):
+            with open(self.fileName) as journalFile:
+                lines = journalFile.read().splitlines()
+            # A crash can leave a half-written last line, which is simply ignored
+            records = []
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+            if records and records[0].get("plan") == self.plan:
+                entries = records[1:]
+            elif checkpoint is None:
+                return False
+        elif checkpoint is None:
+            return False
+
+        if checkpoint is not None:
+            self.pending = array.array('q', checkpoint["pending"])
+            self.failed = {(x, y): code for x, y, code in checkpoint["failed"]}
+        else:
+            self.pending = array.array('q', getTileCoords(tileCollection.tiles))
+            self.failed = {}
+
+        self.done = set()
+        for entry in entries:
+            key = (entry["x"], entry["y"])
+            if entry["status"] == "done":
+                self.done.add(key)
+                self.failed.pop(key, None)
+            else:
+                self.failed[key] = entry["code"]
+
+        return True
+
+    def __checkpoint(self):
+        self.pending = array.array('q', (coord for i in range(0, len(self.pending), 2)
+                                         if (self.pending[i], self.pending[i + 1]) not in self.done
+                                         for coord in (self.pending[i], self.pending[i + 1])))
+        self.done = set()
+        self.sinceCheckpoint = 0
+
+        with open(self.checkpointFileName + ".tmp", "w") as checkpointFile:
+            json.dump({"plan": self.plan, "pending": self.pending.tolist(),
+                       "failed": [[x, y, code] for (x, y), code in self.failed.items()]}, checkpointFile)
+        os.replace(self.checkpointFileName + ".tmp", self.checkpointFileName)
+
+        # Everything in the journal so far is now in the checkpoint, so it can start over
+        if self.journalFile is not None:
+            self.journalFile.close()
+        with open(self.fileName + ".tmp", "w") as journalFile:
+            journalFile.write(json.dumps({"plan": self.plan}) + "\n")
+        os.replace(self.fileName + ".tmp", self.fileName)
+        self.journalFile = open(self.fileName, "a")
+
+
+def getTileCoords(tiles):
+    # Flattened x, y pairs, straight from the TileSequence's coordinates without making a Tile for each
+    for x, y in tiles.getCoords():
+        yield x
+        yield y
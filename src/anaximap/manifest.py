@@ -0,0 +1,79 @@
+# Remembers what we learned about each cached tile: its stored size and modification time, a hash of its contents,
+# its pixel size, mode, transparency, and whether it could be read. As long as a tile's size and modification time
+# haven't changed since, reruns can trust the manifest instead of opening and decoding the tile again.
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class TileManifest:
+    def __init__(self, fileName="manifest.json"):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changed = False
+        if os.path.isfile(fileName):
+            try:
+                with open(fileName) as manifestFile:
+                    self.entries = json.load(manifestFile)
+            except ValueError:
+                print("Tile manifest", fileName, "is unreadable, all tiles will be checked again")
+
+    def lookup(self, tile):
+        # The manifest entry for a tile, or None if there isn't one or the stored tile has changed since
+        with self.lock:
+            entry = self.entries.get(tile.getFileName())
+        if entry is None:
+            return None
+
+        stat = tile.store.stat(tile)
+        if stat is None or [entry["fileSize"], entry["mtime"]] != list(stat):
+            return None
+        return entry
+
+    def isGenerated(self, tile):
+        # Whether the stored tile was built by --pyramidMinZoom rather than downloaded
+        entry = self.lookup(tile)
+        return entry is not None and entry.get("generated", False)
+
+    def record(self, tile, data, tileInfo, generated=False):
+        # tileInfo is the result of scanning the tile's image, or None if it couldn't be read. generated marks tiles we
+        # built ourselves, which downloads replace with the server's
+        stat = tile.store.stat(tile)
+        if stat is None:
+            return
+
+        entry = {
+            "fileSize": stat[0],
+            "mtime": stat[1],
+            "sha1": hashlib.sha1(data).hexdigest(),
+            "valid": tileInfo is not None,
+            "validated": time.time(),
+        }
+        if generated:
+            entry["generated"] = True
+        if tileInfo is not None:
+            entry["size"] = list(tileInfo["size"])
+            entry["mode"] = tileInfo["mode"]
+            entry["transparency"] = tileInfo["transparency"]
+
+        with self.lock:
+            self.entries[tile.getFileName()] = entry
+            self.changed = True
+
+    def merge(self, other):
+        # Adds another manifest's entries, e.g. a shard's, replacing any for the same tiles
+        with self.lock:
+            self.entries.update(other.entries)
+            self.changed = self.changed or bool(other.entries)
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            with open(self.fileName + ".tmp", "w") as manifestFile:
+                json.dump(self.entries, manifestFile)
+            self.changed = False
+            os.replace(self.fileName + ".tmp", self.fileName)
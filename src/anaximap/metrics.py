@@ -0,0 +1,211 @@
+# Counts and times what a run does, instead of printing a line for every tile. Everything is kept in memory and can
+# be written out as JSON Lines (one object per line, ending with a summary) and as a Prometheus textfile for
+# node_exporter's textfile collector. A progress bar stands in for the per tile messages, which are only printed
+# when verbose.
+import bisect
+import collections
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Seconds
+DRAW_INTERVAL = 0.2  # Seconds between progress bar redraws on a terminal
+LOG_INTERVAL = 10  # Seconds between progress lines (and metrics snapshots) otherwise
+BAR_WIDTH = 30
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket is everything above the largest bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def getCumulativeCounts(self):
+        # (upper bound, number of values <= it) pairs, like Prometheus buckets
+        total = 0
+        cumulative = []
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def toDict(self):
+        return {
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): count for bound, count in self.getCumulativeCounts()},
+            "count": self.count,
+            "sum": round(self.sum, 6),
+        }
+
+
+class Metrics:
+    def __init__(self, metricsFile=None, prometheusFile=None, verbose=False, progress=True):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.phases = collections.OrderedDict()  # Phase name to the seconds spent in it
+        self.metricsFile = open(metricsFile, "a") if metricsFile else None
+        self.prometheusFile = os.path.abspath(prometheusFile) if prometheusFile else None  # We chdir while running
+        self.verbose = verbose
+        self.showProgress = progress and not verbose
+        self.isTerminal = sys.stdout.isatty()
+        self.started = time.monotonic()
+
+        self.progressLabel = None
+        self.progressTotal = 0
+        self.progressDone = 0
+        self.progressStarted = 0
+        self.lastDraw = 0
+        self.lastLog = 0
+
+    def log(self, *args):
+        # Per tile messages
+        if self.verbose:
+            print(*args)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def addTime(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start)
+
+    def timeEach(self, phase, iterable):
+        # Yields from iterable, counting the time spent waiting on each item towards phase
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            item = next(iterator, iterator)
+            self.addTime(phase, time.perf_counter() - start)
+            if item is iterator:
+                return
+            yield item
+
+    def startProgress(self, label, total):
+        with self.lock:
+            self.progressLabel = label
+            self.progressTotal = total
+            self.progressDone = 0
+            self.progressStarted = time.monotonic()
+            self.lastDraw = 0
+            self.lastLog = self.progressStarted
+
+    def advance(self, amount=1):
+        with self.lock:
+            self.progressDone += amount
+            now = time.monotonic()
+            draw = self.showProgress and self.isTerminal and now - self.lastDraw >= DRAW_INTERVAL
+            logLine = now - self.lastLog >= LOG_INTERVAL
+            if draw:
+                self.lastDraw = now
+            if logLine:
+                self.lastLog = now
+
+        if draw:
+            print("\r" + self.getProgressLine(), end="", flush=True)
+        if logLine:
+            if self.showProgress and not self.isTerminal:
+                print(self.getProgressLine())
+            self.emit("progress", label=self.progressLabel, done=self.progressDone, total=self.progressTotal,
+                      counters=self.getSnapshot()["counters"])
+            self.writePrometheus()
+
+    def finishProgress(self):
+        if self.showProgress and self.isTerminal and self.progressLabel is not None:
+            print("\r" + self.getProgressLine(), flush=True)
+        self.progressLabel = None
+
+    def getProgressLine(self):
+        done, total = self.progressDone, max(self.progressTotal, 1)
+        elapsed = max(time.monotonic() - self.progressStarted, 1e-6)
+        rate = done / elapsed
+        filled = int(BAR_WIDTH * min(done, total) / total)
+        line = "%s [%s%s] %d/%d %3d%% %.1f/s" % (self.progressLabel, "#" * filled, "-" * (BAR_WIDTH - filled),
+                                                 done, self.progressTotal, 100 * done // total, rate)
+        if 0 < done < total and rate > 0:
+            line += " ETA %ds" % ((total - done) / rate)
+        return line.ljust(BAR_WIDTH + 60)
+
+    def emit(self, event, **fields):
+        if self.metricsFile is None:
+            return
+        with self.lock:
+            self.metricsFile.write(json.dumps(dict({"time": round(time.time(), 3), "event": event}, **fields)) + "\n")
+            self.metricsFile.flush()
+
+    def getSnapshot(self):
+        with self.lock:
+            return {
+                "seconds": round(time.monotonic() - self.started, 3),
+                "counters": dict(self.counters),
+                "phases": {phase: round(seconds, 4) for phase, seconds in self.phases.items()},
+                "histograms": {name: histogram.toDict() for name, histogram in self.histograms.items()},
+            }
+
+    def getPrometheusText(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                metricName = "anaxi_" + getSnakeCase(name) + "_total"
+                lines += ["# TYPE %s counter" % metricName, "%s %s" % (metricName, value)]
+
+            if self.phases:
+                lines.append("# TYPE anaxi_phase_seconds gauge")
+                lines += ['anaxi_phase_seconds{phase="%s"} %f' % (phase, seconds) for phase, seconds in self.phases.items()]
+
+            for name, histogram in sorted(self.histograms.items()):
+                metricName = "anaxi_" + getSnakeCase(name)
+                lines.append("# TYPE %s histogram" % metricName)
+                for bound, count in histogram.getCumulativeCounts():
+                    lines.append('%s_bucket{le="%s"} %d' % (metricName, "+Inf" if bound == float("inf") else bound, count))
+                lines += ["%s_sum %f" % (metricName, histogram.sum), "%s_count %d" % (metricName, histogram.count)]
+        return "\n".join(lines) + "\n"
+
+    def writePrometheus(self):
+        if not self.prometheusFile:
+            return
+        # The textfile collector may read at any time, so never let it see a half written file
+        with open(self.prometheusFile + ".tmp", "w") as prometheusFile:
+            prometheusFile.write(self.getPrometheusText())
+        os.replace(self.prometheusFile + ".tmp", self.prometheusFile)
+
+    def printSummary(self):
+        counters = self.counters
+        print("Downloaded %d tiles (%.1f MB), %d already cached, %d unchanged, %d failed, %d retries in %.1fs" % (
+            counters["tilesDownloaded"], counters["bytesDownloaded"] / 1e6, counters["tilesCached"],
+            counters["tilesNotModified"], counters["tilesFailed"], counters["retries"], time.monotonic() - self.started))
+
+    def close(self):
+        self.emit("summary", **self.getSnapshot())
+        self.writePrometheus()
+        if self.metricsFile is not None:
+            self.metricsFile.close()
+            self.metricsFile = None
+
+
+def getSnakeCase(name):
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
@@ -0,0 +1,210 @@
+# `--pipeline`: stitches the Map while it downloads, instead of downloading every tile and then stitching them all.
+# Downloaders hand each finished tile to a stitching thread through a bounded queue, which decodes and pastes it
+# straight away, so the network and CPU are busy at the same time. A full queue makes the downloaders wait for the
+# stitcher, rather than letting tiles pile up.
+#
+# Streamed Maps (--streamStitch / --geotiff) have to be written a row of tiles at a time, in order. Rows are kept
+# until every tile in them has arrived, and written as soon as they and every row above them are complete. A row with
+# a failed tile is kept until the failed tiles have had their retry, so failures don't hold up the rest of the Map.
+import os
+import queue
+import threading
+import time
+
+from PIL import Image
+
+QUEUE_TILES_PER_WORKER = 4  # Finished tiles waiting to be stitched, per download worker
+
+
+class StitchingFailed(Exception):
+    # Raised to the downloader once the stitcher has failed, stopping a download nothing will use
+    pass
+
+
+class PipelineStitcher:
+    def __init__(self, tileCollection, stitchSaveFormat="", streaming=False, backgroundColor=None, geotiff=False,
+                 queueSize=QUEUE_TILES_PER_WORKER, scale=1.0, maxPixels=0):
+        self.tileCollection = tileCollection
+        self.metrics = tileCollection.metrics
+        self.stitchSaveFormat = stitchSaveFormat
+        self.streaming = streaming or geotiff
+        self.backgroundColor = backgroundColor
+        self.geotiff = geotiff
+        self.scale = scale
+        self.maxPixels = maxPixels
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.thread = threading.Thread(target=self.__run, name="pipeline-stitcher", daemon=True)
+        self.error = None
+
+        # Set up by the first tile, which decides the tile size and whether the Map has an alpha channel
+        self.tileSize = None
+        self.scaledSize = None  # Same as tileSize, when tiles are shrunk as they're decoded
+        self.mode = None
+        self.image = None  # The whole Map, when not streaming
+        self.writer = None
+        self.stitchedImageName = None
+
+        self.strips = {}  # Tile row Y to its strip, for rows still waiting on tiles
+        self.missingTiles = {}  # Tile row Y to how many of its tiles haven't been stitched yet
+        self.nextRow = tileCollection.tileStartY  # First row not yet written
+        self.stitchedTiles = 0
+        self.decodeSeconds = 0
+        self.pasteSeconds = 0
+        self.encodeSeconds = 0
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, tile, downloadResult):
+        # Called by the downloader as each tile finishes
+        if self.error is not None:
+            raise StitchingFailed(self.error)
+        self.queue.put((tile, downloadResult))
+
+    def finish(self):
+        # Returns the same results as TileCollection.stitchImages, once every queued tile is stitched
+        self.queue.put(None)
+        self.thread.join()
+        self.metrics.addTime("decode", self.decodeSeconds)
+        self.metrics.addTime("paste", self.pasteSeconds)
+
+        if self.error is not None:
+            print("ERROR: Stitching failed:", self.error)
+            return {'err': 12}
+        if self.tileSize is None:
+            print("ERROR: None of the tiles could be stitched")
+            return {'err': 12}
+
+        encodeStart = time.perf_counter()
+        if self.writer is not None:
+            # Rows with tiles that never arrived are written with the gaps left in
+            while self.nextRow <= self.tileCollection.tileEndY:
+                self.__writeRow(self.nextRow)
+            self.writer.close()
+        else:
+            print("Saving to {}...".format(self.stitchedImageName))
+            self.image.save(self.stitchedImageName)
+        self.metrics.addTime("encode", self.encodeSeconds + time.perf_counter() - encodeStart)
+
+        print("Stitched image saved to {}".format(os.path.abspath(self.stitchedImageName)))
+        return {'err': 0, 'image': self.image, 'imageName': self.stitchedImageName}
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue  # Keep draining the queue so the downloaders never block on it
+            try:
+                self.__stitchTile(*item)
+            except Exception as e:
+                self.error = e
+
+    def __stitchTile(self, tile, downloadResult):
+        from .tsdl import decodeTileImage, resizeTileImage
+
+        if downloadResult != 200:
+            return  # Its row waits for the retry
+
+        decodeStart = time.perf_counter()
+        tileImage = decodeTileImage(tile.store.open(tile), self.scaledSize)
+        self.decodeSeconds += time.perf_counter() - decodeStart
+        if tileImage is not None and self.tileSize is None:
+            self.__setUp(tileImage)
+
+        self.stitchedTiles += 1
+        self.metrics.log("Stitching [" + str(self.stitchedTiles), "of", str(len(self.tileCollection.tiles)) + "]", tile.getFileName())
+        if tileImage is None:
+            print("Could not read", tile.getFileName() + ", it will be left blank")
+        else:
+            if tileImage.size != self.tileSize:
+                tileImage = resizeTileImage(tileImage, self.tileSize)
+            pasteStart = time.perf_counter()
+            xPastePixel = (tile.tileX - self.tileCollection.tileStartX) * self.tileSize[0]
+            if self.writer is not None:
+                self.__getStrip(tile.tileY).paste(tileImage, (xPastePixel, 0))
+            else:
+                yPastePixel = (tile.tileY - self.tileCollection.tileStartY) * self.tileSize[1]
+                self.image.paste(tileImage, (xPastePixel, yPastePixel))
+            self.pasteSeconds += time.perf_counter() - pasteStart
+
+        self.missingTiles[tile.tileY] = self.missingTiles.get(tile.tileY, self.__getRowLength(tile.tileY)) - 1
+        if self.writer is not None:
+            while self.nextRow <= self.tileCollection.tileEndY and \
+                    self.missingTiles.get(self.nextRow, self.__getRowLength(self.nextRow)) == 0:
+                self.__writeRow(self.nextRow)
+
+    def __setUp(self, tileImage):
+        from .tsdl import getScaledTileSize, imageHasTransparency
+
+        tileCollection = self.tileCollection
+        self.tileSize = getScaledTileSize(tileImage.size, tileCollection.tileEndX - tileCollection.tileStartX + 1,
+                                          tileCollection.tileEndY - tileCollection.tileStartY + 1, self.scale, self.maxPixels)
+        if self.tileSize != tileImage.size:
+            print("Scaling tiles from %dx%d to %dx%d" % (tileImage.size + self.tileSize))
+            self.scaledSize = self.tileSize
+        self.mode = "RGBA" if imageHasTransparency(tileImage) else "RGB"
+        width = (tileCollection.tileEndX - tileCollection.tileStartX + 1) * self.tileSize[0]
+        height = (tileCollection.tileEndY - tileCollection.tileStartY + 1) * self.tileSize[1]
+        print("Canvas Size: %dw x %dh" % (width, height))
+
+        if self.streaming:
+            self.stitchedImageName, stripWriter = tileCollection.getStripWriter(self.stitchSaveFormat, self.geotiff)
+            if stripWriter is None:
+                raise ValueError("unsupported format for streamed stitching")
+            print("Saving to {}...".format(self.stitchedImageName))
+            self.writer = stripWriter(self.stitchedImageName, width, height, self.mode)
+        else:
+            self.stitchedImageName = tileCollection.getMapName(self.stitchSaveFormat)
+            self.image = Image.new(self.mode, (width, height), self.backgroundColor or 0)
+
+    def __getRowLength(self, tileY):
+        # Number of tiles in a row, fewer than the Map is wide when only part of it is covered
+        cover = self.tileCollection.cover
+        if cover is None:
+            return self.tileCollection.tileEndX - self.tileCollection.tileStartX + 1
+        return sum(endX - startX + 1 for startX, endX in cover.rows.get(tileY, []))
+
+    def __getStrip(self, tileY):
+        if tileY not in self.strips:
+            width = (self.tileCollection.tileEndX - self.tileCollection.tileStartX + 1) * self.tileSize[0]
+            self.strips[tileY] = Image.new(self.mode, (width, self.tileSize[1]), self.backgroundColor or 0)
+        return self.strips[tileY]
+
+    def __writeRow(self, tileY):
+        strip = self.__getStrip(tileY)
+        del self.strips[tileY]
+        self.missingTiles.pop(tileY, None)
+        encodeStart = time.perf_counter()
+        self.writer.writeStrip(strip)
+        self.encodeSeconds += time.perf_counter() - encodeStart
+        self.nextRow = tileY + 1
+
+
+def downloadAndStitch(tileCollection, prefs):
+    # Downloads and stitches tileCollection's Map at the same time, then moves it into <name> like stitchAndSave.
+    # Returns the download's error code, or the stitcher's if it failed. The Map is saved even if some tiles
+    # couldn't be downloaded, with gaps where they should be
+    from .tsdl import moveStitchedMap
+
+    if prefs.streamStitch or prefs.geotiff:
+        # Checked before downloading anything, like stitchImages does
+        _, stripWriter = tileCollection.getStripWriter(prefs.stitchFormat, prefs.geotiff)
+        if stripWriter is None:
+            return 11
+
+    stitcher = PipelineStitcher(tileCollection, prefs.stitchFormat, prefs.streamStitch, prefs.backgroundColor, prefs.geotiff,
+                                max(prefs.concurrency, 1) * QUEUE_TILES_PER_WORKER, prefs.scale, prefs.maxPixels)
+    stitcher.start()
+    try:
+        downloadErr = tileCollection.downloadTiles(prefs.forceDownload, prefs.concurrency, prefs.hostConcurrency, prefs.revalidate,
+                                                   prefs.rateLimit, prefs.retries, onResult=stitcher.put, timeout=prefs.timeout)
+    except StitchingFailed:
+        print("Stopping the download, the Map can't be stitched")
+        downloadErr = 1
+    finally:
+        stitchResult = stitcher.finish()
+
+    stitchErr = moveStitchedMap(tileCollection, stitchResult)
+    return stitchErr or downloadErr
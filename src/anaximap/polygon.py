@@ -0,0 +1,157 @@
+# Works out exactly which tiles a GeoJSON (Multi)Polygon touches, so areas like coastlines, corridors or river
+# valleys don't download every tile in their bounding box. A tile touches a polygon if the polygon's outline passes
+# through it, or if it lies inside the polygon. Outline tiles are found by walking each edge a tile row at a time,
+# and the inside with an even-odd scanline fill through the middle of each tile row. Both only visit the rows each
+# edge spans, rather than testing every tile in the bounding box.
+import json
+import math
+
+from . import tilenames
+
+MAX_LATITUDE = 85.0511287798  # Web Mercator stops here
+
+
+class TileCover:
+    # A sparse set of tiles, stored as sorted, non-overlapping, inclusive runs of X for each tile row Y
+    def __init__(self, rows=None):
+        self.rows = {}
+        for y, runs in (rows or {}).items():
+            self.addRuns(y, runs)
+
+    @classmethod
+    def fromTiles(cls, coords):
+        rows = {}
+        for x, y in coords:
+            rows.setdefault(y, []).append((x, x))
+        return cls(rows)
+
+    def addRuns(self, y, runs):
+        merged = []
+        for startX, endX in sorted(self.rows.get(y, []) + list(runs)):
+            if merged and startX <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], endX))
+            else:
+                merged.append((startX, endX))
+        if merged:
+            self.rows[y] = merged
+
+    def union(self, other):
+        for y, runs in other.rows.items():
+            self.addRuns(y, runs)
+        return self
+
+    def clip(self, tileStartX, tileStartY, tileEndX, tileEndY):
+        clipped = TileCover()
+        for y, runs in self.rows.items():
+            if tileStartY <= y <= tileEndY:
+                clipped.addRuns(y, [(max(startX, tileStartX), min(endX, tileEndX)) for startX, endX in runs
+                                    if endX >= tileStartX and startX <= tileEndX])
+        return clipped
+
+    def getBounds(self):
+        # (tileStartX, tileStartY, tileEndX, tileEndY) of the smallest rectangle holding every tile
+        return (min(runs[0][0] for runs in self.rows.values()), min(self.rows),
+                max(runs[-1][1] for runs in self.rows.values()), max(self.rows))
+
+    def __len__(self):
+        return sum(endX - startX + 1 for runs in self.rows.values() for startX, endX in runs)
+
+    def __iter__(self):
+        # (x, y) of every tile, row by row, like TileCollection orders its tiles
+        for y in sorted(self.rows):
+            for startX, endX in self.rows[y]:
+                for x in range(startX, endX + 1):
+                    yield x, y
+
+    def __contains__(self, coords):
+        x, y = coords
+        return any(startX <= x <= endX for startX, endX in self.rows.get(y, []))
+
+
+def loadGeoJSON(fileName):
+    with open(fileName) as geoJSONFile:
+        return json.load(geoJSONFile)
+
+
+def getPolygons(geoJSON):
+    # Every polygon in a GeoJSON object, each as a list of rings of [lon, lat] points (the outline, then any holes)
+    geometryType = geoJSON.get("type")
+    if geometryType == "FeatureCollection":
+        for feature in geoJSON["features"]:
+            yield from getPolygons(feature)
+    elif geometryType == "Feature":
+        if geoJSON.get("geometry"):
+            yield from getPolygons(geoJSON["geometry"])
+    elif geometryType == "GeometryCollection":
+        for geometry in geoJSON["geometries"]:
+            yield from getPolygons(geometry)
+    elif geometryType == "Polygon":
+        yield geoJSON["coordinates"]
+    elif geometryType == "MultiPolygon":
+        yield from geoJSON["coordinates"]
+    else:
+        print("Ignoring GeoJSON", geometryType, "geometry, only Polygons and MultiPolygons are supported")
+
+
+def coverGeoJSON(geoJSON, zoom):
+    cover = TileCover()
+    for rings in getPolygons(geoJSON):
+        cover.union(coverPolygon(rings, zoom))
+    return cover
+
+
+def projectRing(ring, zoom):
+    # A ring's [lon, lat] points as tile (x, y) at zoom, converted all at once when NumPy is installed
+    lons = [point[0] for point in ring]
+    lats = [max(-MAX_LATITUDE, min(MAX_LATITUDE, point[1])) for point in ring]
+    if tilenames.numpy is None:
+        return [tilenames.latlon2xy(lat, lon, zoom) for lat, lon in zip(lats, lons)]
+    xs, ys = tilenames.latlon2xyBatch(lats, lons, zoom)
+    return list(zip(xs.tolist(), ys.tolist()))
+
+
+def coverPolygon(rings, zoom):
+    numTiles = int(tilenames.numTiles(zoom))
+    edges = []
+    for ring in rings:
+        points = projectRing(ring, zoom)
+        edges += [(points[i - 1], points[i]) for i in range(len(points)) if points[i - 1] != points[i]]
+
+    # Bucket each edge into every tile row it spans
+    rowEdges = {}
+    for (x0, y0), (x1, y1) in edges:
+        for row in range(int(math.floor(min(y0, y1))), int(math.floor(max(y0, y1))) + 1):
+            rowEdges.setdefault(row, []).append((x0, y0, x1, y1))
+
+    cover = TileCover()
+    for row, rowEdgeList in rowEdges.items():
+        if row < 0 or row >= numTiles:
+            continue
+
+        runs = []
+        crossings = []
+        middle = row + 0.5
+        for x0, y0, x1, y1 in rowEdgeList:
+            # Tiles the edge itself passes through in this row
+            if y0 == y1:
+                runs.append((math.floor(min(x0, x1)), math.floor(max(x0, x1))))
+            else:
+                top = max(row, min(y0, y1))
+                bottom = min(row + 1, max(y0, y1))
+                xTop = x0 + (top - y0) * (x1 - x0) / (y1 - y0)
+                xBottom = x0 + (bottom - y0) * (x1 - x0) / (y1 - y0)
+                runs.append((math.floor(min(xTop, xBottom)), math.floor(max(xTop, xBottom))))
+
+            # Where the edge crosses the middle of the row, for the fill
+            if (y0 <= middle < y1) or (y1 <= middle < y0):
+                crossings.append(x0 + (middle - y0) * (x1 - x0) / (y1 - y0))
+
+        # Tiles whose centres are inside the polygon
+        crossings.sort()
+        for i in range(0, len(crossings) - 1, 2):
+            runs.append((math.ceil(crossings[i] - 0.5), math.floor(crossings[i + 1] - 0.5)))
+
+        runs = [(max(0, int(startX)), min(numTiles - 1, int(endX))) for startX, endX in runs if startX <= endX]
+        cover.addRuns(row, [(startX, endX) for startX, endX in runs if startX <= endX])
+
+    return cover
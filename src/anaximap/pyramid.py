@@ -0,0 +1,103 @@
+# Builds lower zoom levels of an area from tiles that were already downloaded at a higher zoom, instead of fetching
+# every level from the tile server. Each tile at zoom z-1 covers exactly four tiles at zoom z, so a parent tile is
+# its four children pasted together and scaled down by half.
+#
+# Generated tiles are marked in the manifest, so later downloads at their zoom fetch the server's tiles instead of
+# trusting ours (which may have blank quadrants where the area ends), and real server tiles already stored at a
+# generated zoom are kept rather than replaced. With a shared --cacheDir they are kept out of the cache, in
+# <name>/raw, so other jobs using the cache never see them.
+import io
+
+from PIL import Image
+
+from . import tilestore
+from .polygon import TileCover
+
+# Formats we can give transparent edges, where the area doesn't cover all four children of a parent tile
+ALPHA_EXTENSIONS = (".png", ".webp", ".tif", ".tiff")
+
+
+def buildPyramid(tileCollection, minZoom):
+    # Returns a TileCollection for every generated level, from tileCollection's zoom - 1 down to minZoom
+    if not tileCollection.tileExtension or tileCollection.tileExtension.lower() not in Image.registered_extensions():
+        print("ERROR: Can't build lower zoom levels from", repr(tileCollection.tileExtension), "tiles, PIL can't save that format")
+        return []
+
+    levels = []
+    childCollection = tileCollection
+    with tileCollection.metrics.phase("pyramid"):
+        for zoom in range(tileCollection.zoom - 1, minZoom - 1, -1):
+            print("Building zoom", zoom, "tiles from zoom", zoom + 1)
+            childCollection = buildParentLevel(childCollection)
+            levels.append(childCollection)
+    return levels
+
+
+def buildParentLevel(childCollection):
+    from .tsdl import TileCollection, scanTileImage
+
+    name = childCollection.name
+    if name != "tiles":
+        name = "%s_z%d" % (name, childCollection.zoom - 1)
+    parentCover = None
+    if childCollection.cover is not None:
+        parentCover = TileCover.fromTiles((x // 2, y // 2) for x, y in childCollection.cover)
+    parentStore = childCollection.store
+    if isinstance(parentStore, tilestore.CacheTileStore):
+        parentStore = tilestore.FileTileStore(dedup=parentStore.dedup)
+    parentCollection = TileCollection(childCollection.tileStartX // 2, childCollection.tileStartY // 2,
+                                      childCollection.tileEndX // 2, childCollection.tileEndY // 2,
+                                      childCollection.zoom - 1, childCollection.tileServer, name,
+                                      parentStore, childCollection.manifest, parentCover, childCollection.metrics)
+    tileExtension = childCollection.tileExtension
+    parentCollection.tileExtension = tileExtension
+    imageFormat = Image.registered_extensions()[tileExtension.lower()]
+    mode = "RGBA" if tileExtension.lower() in ALPHA_EXTENSIONS else "RGB"
+    tileWidth, tileHeight = childCollection.getMaxTileSize()
+
+    metrics = parentCollection.metrics
+    builtTiles = 0
+    keptTiles = 0
+    metrics.startProgress("Building zoom %d" % parentCollection.zoom, len(parentCollection.tiles))
+    for parentTile in parentCollection.tiles:
+        if parentTile.doesTileImageFileExist() and not (parentCollection.manifest is not None and parentCollection.manifest.isGenerated(parentTile)):
+            keptTiles += 1  # Downloaded from the server, which beats anything we'd build
+            metrics.advance()
+            continue
+
+        # Pasting into a premultiplied canvas stops the transparent, missing children bleeding black into the edges
+        canvas = Image.new("RGBa" if mode == "RGBA" else mode, (tileWidth * 2, tileHeight * 2))
+        for dy in range(2):
+            for dx in range(2):
+                childTile = childCollection.makeTile(parentTile.tileX * 2 + dx, parentTile.tileY * 2 + dy)
+                if not childTile.doesTileImageFileExist():
+                    continue  # Outside the downloaded area
+                try:
+                    childImage = childTile.openImage().convert(mode).convert(canvas.mode)
+                except OSError:
+                    print("Could not read", childTile.getFileName() + ", leaving it blank")
+                    continue
+                if childImage.size != (tileWidth, tileHeight):
+                    childImage = childImage.resize((tileWidth, tileHeight))
+                canvas.paste(childImage, (dx * tileWidth, dy * tileHeight))
+
+        parentImage = canvas.reduce(2).convert(mode)
+        parentData = io.BytesIO()
+        parentImage.save(parentData, imageFormat)
+        parentCollection.store.write(parentTile, parentData.getvalue())
+        if parentCollection.manifest is not None:
+            parentCollection.manifest.record(parentTile, parentData.getvalue(), scanTileImage(io.BytesIO(parentData.getvalue())), generated=True)
+
+        builtTiles += 1
+        metrics.log("Built [" + str(builtTiles), "of", str(len(parentCollection.tiles)) + "]", parentTile.getFileName())
+        metrics.advance()
+    metrics.finishProgress()
+    metrics.increment("tilesBuilt", builtTiles)
+    if keptTiles:
+        print("Kept", keptTiles, "zoom", parentCollection.zoom, "tiles already downloaded from the server")
+
+    parentCollection.store.flush()
+    if parentCollection.manifest is not None:
+        parentCollection.manifest.save()
+
+    return parentCollection
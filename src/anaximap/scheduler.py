@@ -0,0 +1,162 @@
+# Paces requests to each tile server host. Every host gets a cap on concurrent requests and a token bucket whose
+# rate adapts to the server: it is halved when enough of the last RATE_WINDOW seconds' responses were the server
+# pushing back (429 / 503, or a Retry-After), at most once per window, and slowly raised again while requests succeed.
+# Other failures (connection errors, 500 / 502 / 504) are only retried, they don't slow the host down. Failed requests
+# are retried with exponential backoff and jitter, honouring Retry-After when the server sends one.
+import collections
+import contextlib
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+PUSHBACK_STATUS_CODES = (429, 503)  # The server asking us to slow down, rather than just failing
+PUSHBACK_FRACTION = 0.1  # Slow down when at least this much of the window's responses were push back
+MIN_RATE = 0.5  # Never slow a host below one request every two seconds
+RATE_WINDOW = 10  # Seconds of history used to estimate our request rate and the host's push back rate
+CONNECT_TIMEOUT = 10  # Seconds to wait for a connection to a host
+READ_TIMEOUT = 30  # Seconds a response may stall for before the request is retried
+
+
+class TokenBucket:
+    def __init__(self, rate=None):
+        self.rate = rate  # Requests per second, or None for no limit
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.pausedUntil = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.pausedUntil:
+                    wait = self.pausedUntil - now
+                elif self.rate is None:
+                    return
+                else:
+                    # Allow at most one second's worth of burst
+                    self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + seconds)
+
+
+class HostState:
+    def __init__(self, perHost, rateLimit):
+        self.slots = threading.BoundedSemaphore(perHost)
+        self.bucket = TokenBucket(rateLimit)
+        self.requestTimes = collections.deque()
+        self.responses = collections.deque()  # (time, pushed back) of the responses since the window / last slow down began
+        self.pushbacks = 0  # Pushed back responses in responses
+        self.lastSlowdown = None
+        self.successStreak = 0
+
+
+class DownloadScheduler:
+    def __init__(self, perHost, rateLimit=None, retries=3, backoffBase=0.5, backoffMax=60, timeout=READ_TIMEOUT):
+        self.perHost = perHost
+        self.rateLimit = rateLimit or None  # Also the ceiling when speeding back up
+        self.retries = retries
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.timeout = getRequestTimeout(timeout)
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def getHost(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostState(self.perHost, self.rateLimit)
+            return self.hosts[host]
+
+    @contextlib.contextmanager
+    def forURL(self, url):
+        # Hold this around a request, it waits for both a free slot and a token for the URL's host
+        hostState = self.getHost(url)
+        with hostState.slots:
+            hostState.bucket.acquire()
+            with self.lock:
+                now = time.monotonic()
+                hostState.requestTimes.append(now)
+                while hostState.requestTimes[0] < now - RATE_WINDOW:
+                    hostState.requestTimes.popleft()
+            yield
+
+    def report(self, url, statusCode, retryAfter=None):
+        # Feeds a response (statusCode None for a connection error) back into the host's rate
+        hostState = self.getHost(url)
+        bucket = hostState.bucket
+        pushedBack = statusCode in PUSHBACK_STATUS_CODES or retryAfter is not None
+        with self.lock:
+            now = time.monotonic()
+            hostState.responses.append((now, pushedBack))
+            hostState.pushbacks += pushedBack
+            while hostState.responses[0][0] < now - RATE_WINDOW:
+                hostState.pushbacks -= hostState.responses.popleft()[1]
+
+            if pushedBack:
+                hostState.successStreak = 0
+                # Responses to the burst of requests sent before slowing down don't slow us down again
+                slowedRecently = hostState.lastSlowdown is not None and now - hostState.lastSlowdown < RATE_WINDOW
+                if not slowedRecently and hostState.pushbacks >= PUSHBACK_FRACTION * len(hostState.responses):
+                    currentRate = bucket.rate or self.__getObservedRate(hostState)
+                    bucket.rate = max(MIN_RATE, currentRate / 2)
+                    hostState.lastSlowdown = now
+                    hostState.responses.clear()
+                    hostState.pushbacks = 0
+            elif statusCode is not None and statusCode not in RETRYABLE_STATUS_CODES and bucket.rate is not None:
+                hostState.successStreak += 1
+                if hostState.successStreak >= max(10, bucket.rate):
+                    hostState.successStreak = 0
+                    bucket.rate *= 1.25
+                    if self.rateLimit is not None:
+                        bucket.rate = min(bucket.rate, self.rateLimit)
+
+        if retryAfter is not None:
+            bucket.pause(retryAfter)
+
+    def shouldRetry(self, statusCode, attempt):
+        return attempt < self.retries and (statusCode is None or statusCode in RETRYABLE_STATUS_CODES)
+
+    def getBackoff(self, attempt, retryAfter=None):
+        # "Full jitter" exponential backoff, but never sooner than the server asked us to wait
+        backoff = random.uniform(0, min(self.backoffMax, self.backoffBase * (2 ** attempt)))
+        if retryAfter is not None:
+            backoff = max(backoff, retryAfter)
+        return backoff
+
+    def __getObservedRate(self, hostState):
+        if len(hostState.requestTimes) < 2:
+            return 1.0
+        elapsed = max(time.monotonic() - hostState.requestTimes[0], 1.0)
+        return len(hostState.requestTimes) / elapsed
+
+
+def getRequestTimeout(readTimeout=READ_TIMEOUT):
+    # (connect, read) timeout for requests, a stalled connection raises and is retried like any other failure
+    return min(CONNECT_TIMEOUT, readTimeout), readTimeout
+
+
+def parseRetryAfter(value):
+    # Retry-After is either a number of seconds or an HTTP date. Returns seconds, or None if missing / unreadable
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,292 @@
+# `anaxi serve`: a long running caching proxy in front of a tile server, so several services can share one tile cache
+# instead of each downloading their own. Tiles are served from a small in-memory LRU of hot tiles, then from the same
+# on-disk tile store anaxi downloads into, and only fetched from the upstream server when missing. Concurrent
+# requests for the same missing tile share a single upstream fetch.
+#
+#   GET /{z}/{x}/{y}[.ext]  A single tile
+#   GET /region?latStart=&lonStart=&latEnd=&lonEnd=&zoom=[&format=.png]  The tiles covering an area, stitched together
+#   GET /metrics  Counters in the Prometheus text format
+#
+# The proxy keeps no manifest, one would only grow for as long as it runs. With a shared --cacheDir, only the tiles
+# used since the last save but one are protected from eviction, rather than everything since the proxy started.
+import argparse
+import collections
+import io
+import mimetypes
+import os
+import re
+import signal
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+from . import tilestore
+from .metrics import Metrics
+from .scheduler import READ_TIMEOUT, DownloadScheduler
+from .tsdl import (AnaxiPreferences, Tile, decodeTileImage, getFileExtension, getTileBounds, imageHasTransparency,
+                   newSession, openTileStore, resolveTileServer)
+
+TILE_PATH = re.compile(r"^/(\d+)/(\d+)/(\d+)(\.\w+)?$")
+SAVE_EVERY = 100  # Upstream fetches between flushing the tile store to disk
+
+
+class MemoryTileCache:
+    # The most recently used tiles, up to a total size in bytes
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.tiles = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.tiles.get(key)
+            if data is not None:
+                self.tiles.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.maxBytes:
+            return
+        with self.lock:
+            if key in self.tiles:
+                self.size -= len(self.tiles.pop(key))
+            self.tiles[key] = data
+            self.size += len(data)
+            while self.size > self.maxBytes:
+                self.size -= len(self.tiles.popitem(last=False)[1])
+
+
+class TileProxy:
+    def __init__(self, tileServer, store, metrics, memoryCacheBytes=64 * 1024 * 1024, concurrency=8,
+                 rateLimit=0, retries=3, maxRegionTiles=256, timeout=READ_TIMEOUT):
+        self.tileServer = tileServer
+        self.tileExtension = getFileExtension(tileServer)  # Guessed from the first fetched tile if the URL has none
+        self.store = store
+        self.metrics = metrics
+        self.memoryCache = MemoryTileCache(memoryCacheBytes)
+        self.session = newSession(concurrency)
+        self.scheduler = DownloadScheduler(concurrency, rateLimit, retries, timeout=timeout)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.maxRegionTiles = maxRegionTiles
+        self.lock = threading.Lock()
+        self.fetching = {}  # (zoom, x, y) to the Future of the upstream fetch in progress
+        self.fetchesSinceSave = 0
+        self.lastSave = time.time()
+
+    def getTile(self, zoom, x, y):
+        # Returns (HTTP status code, tile data, where it came from)
+        if not (0 <= zoom <= 30 and 0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+            return 404, None, None
+        key = (zoom, x, y)
+        self.metrics.increment("tilesServed")
+
+        data = self.memoryCache.get(key)
+        if data is not None:
+            self.metrics.increment("memoryHits")
+            return 200, data, "memory"
+
+        tile = Tile(zoom, x, y, self.tileServer, self.store, tileExtension=self.tileExtension)
+        data = self.store.read(tile) if self.tileExtension else None
+        if data is not None:
+            self.metrics.increment("diskHits")
+            self.memoryCache.put(key, data)
+            return 200, data, "disk"
+
+        with self.lock:
+            future = self.fetching.get(key)
+            fetching = future is None
+            if fetching:
+                future = Future()
+                self.fetching[key] = future
+
+        if not fetching:
+            self.metrics.increment("coalescedFetches")
+            statusCode, data = future.result()
+            return statusCode, data, "upstream"
+
+        try:
+            statusCode, data = self.__fetch(tile)
+            if data is not None:
+                self.memoryCache.put(key, data)
+            future.set_result((statusCode, data))
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.fetching[key]
+        return statusCode, data, "upstream"
+
+    def __fetch(self, tile):
+        self.metrics.increment("upstreamFetches")
+        statusCode = tile.download(True, self.scheduler, self.session, metrics=self.metrics)
+        if statusCode != 200:
+            return statusCode or 502, None
+
+        if not self.tileExtension:
+            self.tileExtension = tile.tileExtension
+        data = self.store.read(tile)
+
+        with self.lock:
+            self.fetchesSinceSave += 1
+            save = self.fetchesSinceSave >= SAVE_EVERY
+            if save:
+                self.fetchesSinceSave = 0
+        if save:
+            self.save()
+        return 200, data
+
+    def getRegion(self, latStart, lonStart, latEnd, lonEnd, zoom, stitchFormat=".png"):
+        # Returns (HTTP status code, stitched image data or an error message)
+        tileStartX, tileStartY, tileEndX, tileEndY = getTileBounds(latStart, lonStart, latEnd, lonEnd, zoom)
+        numTiles = (tileEndX - tileStartX + 1) * (tileEndY - tileStartY + 1)
+        if numTiles > self.maxRegionTiles:
+            return 413, "Region covers %d tiles, the limit is %d" % (numTiles, self.maxRegionTiles)
+        imageFormat = Image.registered_extensions().get(stitchFormat.lower())
+        if imageFormat is None:
+            return 400, "Unknown format " + stitchFormat
+
+        coords = [(x, y) for y in range(tileStartY, tileEndY + 1) for x in range(tileStartX, tileEndX + 1)]
+        results = self.executor.map(lambda coord: self.getTile(zoom, coord[0], coord[1]), coords)
+
+        tileImages = []
+        for (x, y), (statusCode, data, source) in zip(coords, results):
+            tileImages.append(((x, y), decodeTileImage(io.BytesIO(data)) if data is not None else None))
+
+        decodedImages = [tileImage for _, tileImage in tileImages if tileImage is not None]
+        if not decodedImages:
+            return 502, "None of the region's tiles could be fetched"
+        tileWidth, tileHeight = decodedImages[0].size
+        mode = "RGBA" if imageHasTransparency(decodedImages[0]) and imageFormat != "JPEG" else "RGB"
+
+        image = Image.new(mode, ((tileEndX - tileStartX + 1) * tileWidth, (tileEndY - tileStartY + 1) * tileHeight))
+        for (x, y), tileImage in tileImages:
+            if tileImage is not None:
+                image.paste(tileImage.convert(mode), ((x - tileStartX) * tileWidth, (y - tileStartY) * tileHeight))
+
+        imageData = io.BytesIO()
+        image.save(imageData, imageFormat)
+        self.metrics.increment("regionsServed")
+        return 200, imageData.getvalue()
+
+    def save(self):
+        if isinstance(self.store, tilestore.CacheTileStore):
+            self.store.sessionStarted, self.lastSave = self.lastSave, time.time()
+        self.store.flush()
+
+    def close(self):
+        self.executor.shutdown()
+        self.save()
+        self.store.close()
+
+
+def makeRequestHandler(proxy, verbose=False):
+    class TileRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            if verbose:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            tileMatch = TILE_PATH.match(url.path)
+            if tileMatch:
+                zoom, x, y = int(tileMatch.group(1)), int(tileMatch.group(2)), int(tileMatch.group(3))
+                statusCode, data, source = proxy.getTile(zoom, x, y)
+                if statusCode != 200:
+                    self.sendText(statusCode, "Could not get tile %d/%d/%d" % (zoom, x, y))
+                    return
+                contentType = mimetypes.guess_type("tile" + (proxy.tileExtension or ".png"))[0]
+                self.send(200, data, contentType or "application/octet-stream", {"X-Anaxi-Cache": source})
+            elif url.path == "/region":
+                self.sendRegion(parse_qs(url.query))
+            elif url.path == "/metrics":
+                self.sendText(200, proxy.metrics.getPrometheusText())
+            else:
+                self.sendText(404, "Not found, try /{z}/{x}/{y} or /region")
+
+        def sendRegion(self, query):
+            try:
+                corners = [float(query[name][0]) for name in ("latStart", "lonStart", "latEnd", "lonEnd")]
+                zoom = int(query["zoom"][0])
+            except (KeyError, ValueError):
+                self.sendText(400, "/region needs latStart, lonStart, latEnd, lonEnd and zoom")
+                return
+            stitchFormat = query.get("format", [".png"])[0]
+            if not stitchFormat.startswith("."):
+                stitchFormat = "." + stitchFormat
+
+            statusCode, data = proxy.getRegion(*corners, zoom, stitchFormat)
+            if statusCode != 200:
+                self.sendText(statusCode, data)
+                return
+            self.send(200, data, mimetypes.guess_type("region" + stitchFormat)[0] or "application/octet-stream")
+
+        def sendText(self, statusCode, text):
+            self.send(statusCode, text.encode(), "text/plain; charset=utf-8")
+
+        def send(self, statusCode, body, contentType, headers=None):
+            self.send_response(statusCode)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+    return TileRequestHandler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="anaxi serve", description="Serve tiles from the local tile cache, fetching missing ones from a tile server")
+    parser.add_argument('tileServer', type=str, help="URL (or ID) of the upstream Tile Server")
+    parser.add_argument('--name', type=str, default="tiles", help="Tile cache to serve from, the same as anaxi --name")
+    parser.add_argument('--tileStore', choices=["files", "mbtiles"], default="files", help="How the tile cache is kept, the same as anaxi --tileStore")
+    parser.add_argument('--dedup', action='store_true', help="Store identical tiles only once, the same as anaxi --dedup")
+    parser.add_argument('--cacheDir', type=str, default=None, help="Serve from this cache directory shared with anaxi --cacheDir and other proxies, instead of <name>/raw")
+    parser.add_argument('--cacheMaxSize', type=int, default=0, help="MB the shared cache may grow to before the least recently used tiles are evicted (default: unlimited)")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on")
+    parser.add_argument('--memoryCache', type=int, default=64, help="MB of hot tiles to keep in memory")
+    parser.add_argument('--concurrency', type=int, default=8, help="Max concurrent requests to the upstream server")
+    parser.add_argument('--rateLimit', type=float, default=0, help="Max requests per second to the upstream server")
+    parser.add_argument('--retries', type=int, default=3, help="Times to retry a tile after a throttled / failed request")
+    parser.add_argument('--timeout', type=float, default=READ_TIMEOUT, help="Seconds an upstream request may stall for before it's retried")
+    parser.add_argument('--maxRegionTiles', type=int, default=256, help="Largest number of tiles a /region request may cover")
+    parser.add_argument('--verbose', action='store_true', help="Log every request")
+    args = parser.parse_args(argv)
+
+    tileServer = resolveTileServer(args.tileServer)
+    prefs = AnaxiPreferences(0, 0, 0, 0, 0, tileServer, name=args.name, tileStore=args.tileStore, dedup=args.dedup,
+                             cacheDir=args.cacheDir, cacheMaxSize=args.cacheMaxSize)
+    if not prefs.cacheDir:
+        os.makedirs(os.path.join(args.name, "raw"), exist_ok=True)
+        os.chdir(os.path.join(args.name, "raw"))
+
+    proxy = TileProxy(tileServer, openTileStore(prefs), Metrics(verbose=args.verbose, progress=False),
+                      args.memoryCache * 1024 * 1024, args.concurrency, args.rateLimit, args.retries, args.maxRegionTiles,
+                      args.timeout)
+
+    httpServer = ThreadingHTTPServer((args.host, args.port), makeRequestHandler(proxy, args.verbose))
+    httpServer.daemon_threads = True
+    print("Serving", tileServer, "at http://%s:%d/{z}/{x}/{y}" % (args.host, httpServer.server_address[1]))
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    # Shut down cleanly (saving any buffered tiles) when stopped by a service manager too
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        httpServer.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down")
+    finally:
+        httpServer.server_close()
+        proxy.close()
+    return 0
@@ -0,0 +1,104 @@
+# Splits one download between several processes or machines sharing a tile store. `--shard i/N` downloads only the
+# i-th of N equal blocks of the job's tiles. Blocks are contiguous runs of the row by row tile order, so each shard
+# covers a band of the area, and every shard works out the same split from the same arguments. Shards keep their own
+# manifest, journal and validators so they never write the same file, and leave a marker behind once they're done.
+# `--mergeShards N` then checks every marker is there, merges the shards' manifests and stitches the Map as usual.
+import argparse
+import json
+import os
+import time
+
+from .manifest import TileManifest
+
+
+def parseShard(shard):
+    # "2/4" to (2, 4), for argparse
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shards are given as i/N, e.g. 2/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard %d/%d doesn't exist, they're numbered 1/%d to %d/%d" % (index, count, count, count, count))
+    return index, count
+
+
+def getShardTiles(tiles, index, count):
+    # The index-th of count contiguous, equally sized blocks of a TileSequence
+    return tiles[len(tiles) * (index - 1) // count:len(tiles) * index // count]
+
+
+def getShardFileName(fileName, shard):
+    # e.g. manifest.json to manifest.shard-2-of-4.json, for files every shard would otherwise write to
+    if shard is None:
+        return fileName
+    base, extension = os.path.splitext(fileName)
+    return "%s.shard-%d-of-%d%s" % (base, shard[0], shard[1], extension)
+
+
+def getMarkerFileName(shard):
+    return "shard-%d-of-%d.done" % shard
+
+
+def getJobPlan(tileCollection):
+    # Identifies the whole job a shard is part of, markers from a different job never count
+    cover = tileCollection.cover
+    numTiles = len(cover) if cover is not None else \
+        (tileCollection.tileEndX - tileCollection.tileStartX + 1) * (tileCollection.tileEndY - tileCollection.tileStartY + 1)
+    return {
+        "tileServer": tileCollection.tileServer,
+        "zoom": tileCollection.zoom,
+        "tileStartX": tileCollection.tileStartX,
+        "tileStartY": tileCollection.tileStartY,
+        "tileEndX": tileCollection.tileEndX,
+        "tileEndY": tileCollection.tileEndY,
+        "numTiles": numTiles,
+    }
+
+
+def clearMarker(shard):
+    # A shard that's running again isn't done any more
+    if os.path.isfile(getMarkerFileName(shard)):
+        os.remove(getMarkerFileName(shard))
+
+
+def writeMarker(tileCollection):
+    marker = {
+        "shard": list(tileCollection.shard),
+        "plan": getJobPlan(tileCollection),
+        "numTiles": len(tileCollection.tiles),
+        "tileExtension": tileCollection.tileExtension,
+        "finished": time.time(),
+    }
+    with open(getMarkerFileName(tileCollection.shard) + ".tmp", "w") as markerFile:
+        json.dump(marker, markerFile)
+    os.replace(getMarkerFileName(tileCollection.shard) + ".tmp", getMarkerFileName(tileCollection.shard))
+    print("Shard %d of %d is done" % tileCollection.shard)
+
+
+def loadMarker(shard):
+    try:
+        with open(getMarkerFileName(shard)) as markerFile:
+            return json.load(markerFile)
+    except (OSError, ValueError):
+        return None
+
+
+def mergeShards(tileCollection, count):
+    # Gets tileCollection (the whole job) ready to stitch from count finished shards. Returns 0 if they all are
+    plan = getJobPlan(tileCollection)
+    markers = [loadMarker((index, count)) for index in range(1, count + 1)]
+    unfinished = [str(index) for index, marker in enumerate(markers, 1) if marker is None or marker["plan"] != plan]
+    if unfinished:
+        print("ERROR: Shards", ", ".join(unfinished), "of", count, "haven't finished this job yet")
+        return 1
+
+    if not tileCollection.tileExtension:
+        # Shards with no tiles (more shards than tiles) never found out the extension
+        tileCollection.tileExtension = next((marker["tileExtension"] for marker in markers if marker["tileExtension"]), "")
+    if tileCollection.manifest is not None:
+        for index in range(1, count + 1):
+            tileCollection.manifest.merge(TileManifest(getShardFileName(tileCollection.manifest.fileName, (index, count))))
+        tileCollection.manifest.save()
+
+    print("All", count, "shards are done, with", sum(marker["numTiles"] for marker in markers), "tiles between them")
+    return 0
@@ -9,6 +9,11 @@
 
 from math import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Only needed for the batch conversions
+
 def horozontalDistance(lat, zoom):
     # See https://wiki.openstreetmap.org/wiki/Zoom_levels
     circOfEarth = 2 * pi * 6378137 # in meters
@@ -78,6 +83,14 @@ def mercatorToLat(mercatorY):
     return (degrees(atan(sinh(mercatorY))))
 
 
+def latlon2meters(lat, lon):
+    # Spherical ("Web") Mercator coordinates in meters, EPSG:3857
+    radius = 6378137
+    x = radius * radians(lon)
+    y = radius * log(tan(pi / 4 + radians(lat) / 2))
+    return (x, y)
+
+
 def tileLayerBase(layer):
     layers = { \
         "tah": "http://cassini.toolserver.org:8080/http://a.tile.openstreetmap.org/+http://toolserver.org/~cmarqu/hill/",
@@ -86,3 +99,76 @@ def tileLayerBase(layer):
         "mapnik": "http://tile.openstreetmap.org/mapnik/"
     }
     return (layers[layer])
+
+
+# Batch versions of the conversions above, for working on many points at once.
+# They take and return NumPy arrays (anything array-like is accepted), z may be a single zoom or an array of zooms,
+# and give the same results as calling the single point versions in a loop.
+
+def requireNumpy():
+    if numpy is None:
+        raise ImportError("Batch tile conversions require NumPy, install it with `pip install numpy`")
+
+
+def numTilesBatch(z):
+    requireNumpy()
+    return numpy.power(2.0, z)
+
+
+def latlon2relativeXYBatch(lats, lons):
+    requireNumpy()
+    lats = numpy.radians(numpy.asarray(lats, dtype=float))
+    lons = numpy.asarray(lons, dtype=float)
+    x = (lons + 180) / 360
+    y = (1 - numpy.log(numpy.tan(lats) + 1 / numpy.cos(lats)) / pi) / 2
+    return (x, y)
+
+
+def latlon2xyBatch(lats, lons, z):
+    n = numTilesBatch(z)
+    x, y = latlon2relativeXYBatch(lats, lons)
+    return (n * x, n * y)
+
+
+def tileXYBatch(lats, lons, z, raw=False):
+    x, y = latlon2xyBatch(lats, lons, z)
+    if raw:
+        return (x, y)
+    return (x.astype(numpy.int64), y.astype(numpy.int64))  # Truncates like int() does
+
+
+def xy2latlonBatch(xs, ys, z):
+    n = numTilesBatch(z)
+    relY = numpy.asarray(ys, dtype=float) / n
+    lat = mercatorToLatBatch(pi * (1 - 2 * relY))
+    lon = -180.0 + 360.0 * numpy.asarray(xs, dtype=float) / n
+    return (lat, lon)
+
+
+def latEdgesBatch(ys, z):
+    n = numTilesBatch(z)
+    unit = 1 / n
+    relY1 = numpy.asarray(ys, dtype=float) * unit
+    relY2 = relY1 + unit
+    lat1 = mercatorToLatBatch(pi * (1 - 2 * relY1))
+    lat2 = mercatorToLatBatch(pi * (1 - 2 * relY2))
+    return (lat1, lat2)
+
+
+def lonEdgesBatch(xs, z):
+    n = numTilesBatch(z)
+    unit = 360 / n
+    lon1 = -180 + numpy.asarray(xs, dtype=float) * unit
+    lon2 = lon1 + unit
+    return (lon1, lon2)
+
+
+def tileEdgesBatch(xs, ys, z):
+    lat1, lat2 = latEdgesBatch(ys, z)
+    lon1, lon2 = lonEdgesBatch(xs, z)
+    return ((lat2, lon1, lat1, lon2))  # S,W,N,E
+
+
+def mercatorToLatBatch(mercatorY):
+    requireNumpy()
+    return numpy.degrees(numpy.arctan(numpy.sinh(mercatorY)))
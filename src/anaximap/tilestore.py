@@ -0,0 +1,349 @@
+# Where downloaded tiles live. Every store is addressed by Tile objects (zoom, tileX, tileY, tileExtension),
+# so the downloader and stitcher don't need to care how the bytes are kept on disk.
+#
+# With dedup, identical tiles (open ocean, empty land, "no data" tiles) are only stored once: files are hardlinks to
+# a single copy in objects/, named by the hash of its contents, and MBTiles rows point at a shared image row.
+#
+# A CacheTileStore keeps tiles in one cache directory shared by every job, instead of under each job's --name.
+import hashlib
+import io
+import os
+import re
+import sqlite3
+import threading
+import time
+
+PRUNE_MARGIN = 2  # Seconds, see FileTileStore.__pruneObjects
+SESSION_STARTED = time.time()  # Every CacheTileStore a run opens protects the tiles any of them have used since
+
+
+class FileTileStore:
+    # The original layout: one zoom_x_y.ext file per tile, in the working directory unless told otherwise
+    def __init__(self, root=".", dedup=False):
+        self.root = root
+        self.dedup = dedup
+        self.objectsDir = os.path.join(root, "objects")
+        self.linked = 0
+        self.canLink = True
+        self.opened = time.time()
+
+    def getPath(self, tile):
+        return os.path.join(self.root, tile.getFileName())
+
+    def has(self, tile):
+        return os.path.isfile(self.getPath(tile))
+
+    def open(self, tile):
+        # Returns something Image.open accepts
+        return self.getPath(tile)
+
+    def stat(self, tile):
+        # (size, modification time) of a stored tile, or None if it isn't stored
+        try:
+            fileStat = os.stat(self.getPath(tile))
+        except FileNotFoundError:
+            return None
+        return fileStat.st_size, fileStat.st_mtime_ns
+
+    def read(self, tile):
+        try:
+            with open(self.getPath(tile), 'rb') as tileImageFile:
+                return tileImageFile.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, tile, data):
+        if self.dedup and self.canLink:
+            self.__writeLinked(tile, data)
+            return
+
+        # Replace rather than overwrite, a tile may be a hardlink shared with other tiles from a dedup run
+        path = self.getPath(tile)
+        with open(path + ".tmp", 'wb') as tileImageFile:
+            tileImageFile.write(data)
+        os.replace(path + ".tmp", path)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.dedup and self.canLink:
+            self.__pruneObjects()
+
+    def __writeLinked(self, tile, data):
+        # Every tile with the same contents is a hardlink to objects/ab/abcdef....ext
+        tileHash = hashlib.sha1(data).hexdigest()
+        objectPath = os.path.join(self.objectsDir, tileHash[:2], tileHash + tile.tileExtension)
+        path = self.getPath(tile)
+        try:
+            self.__linkObject(objectPath, path + ".tmp", data)
+        except OSError as e:
+            print("Can't hardlink tiles here (" + str(e) + "), saving every tile separately")
+            self.canLink = False
+            self.write(tile, data)
+            return
+        os.replace(path + ".tmp", path)
+        self.linked += 1
+
+    def __linkObject(self, objectPath, linkPath, data, retries=3):
+        # Another process sharing the store (e.g. a --shard) may prune an object between us writing or finding it and
+        # linking to it, it's written again when that happens
+        for attempt in range(retries + 1):
+            if not os.path.isfile(objectPath):
+                os.makedirs(os.path.dirname(objectPath), exist_ok=True)
+                # Other threads, or other processes sharing the store, may be writing the same object
+                tempPath = objectPath + ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+                with open(tempPath, 'wb') as objectFile:
+                    objectFile.write(data)
+                os.replace(tempPath, objectPath)
+
+            if os.path.lexists(linkPath):
+                os.remove(linkPath)
+            try:
+                os.link(objectPath, linkPath)
+                return
+            except FileNotFoundError:
+                if attempt == retries:
+                    raise
+
+    def __pruneObjects(self):
+        # Objects no tile links to any more (the tile was downloaded again with different contents) are removed.
+        # Only ones older than the store, others sharing it (e.g. other --shards) may have written new ones they're
+        # about to link to. Objects are kept a little longer than that, for filesystems with coarse timestamps
+        if not os.path.isdir(self.objectsDir):
+            return
+        objects = 0
+        for directory in os.scandir(self.objectsDir):
+            if not directory.is_dir():
+                continue
+            for objectFile in os.scandir(directory.path):
+                try:
+                    objectStat = objectFile.stat()
+                    if objectStat.st_nlink <= 1 and objectStat.st_mtime < self.opened - PRUNE_MARGIN:
+                        os.remove(objectFile.path)
+                        continue
+                except FileNotFoundError:
+                    continue  # Pruned by another process sharing the store
+                objects += 1
+        if self.linked:
+            print("Saved", self.linked, "tiles, the tile cache now holds", objects, "unique tiles")
+
+
+class MBTilesTileStore:
+    # Every tile in a single SQLite database, following https://github.com/mapbox/mbtiles-spec
+    # Writes are buffered and inserted in bulk, one transaction per batch
+    # With dedup, the database uses the spec's map / images layout, with tiles as a view joining the two
+    def __init__(self, fileName, name="tiles", batchSize=500, dedup=False):
+        self.fileName = fileName
+        self.name = name
+        self.batchSize = batchSize
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.tileFormat = None
+
+        self.connection = sqlite3.connect(fileName, timeout=60, check_same_thread=False)  # Waits out other shards' writes
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        row = self.connection.execute("SELECT type FROM sqlite_master WHERE name = 'tiles'").fetchone()
+        if row is not None and dedup != (row[0] == "view"):
+            # The layout can't be switched after the fact, keep using whichever one the database already has
+            print(fileName, "was created", "without" if dedup else "with", "--dedup, keeping its existing layout")
+            dedup = row[0] == "view"
+        self.dedup = dedup
+
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+            if dedup:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)")
+                self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)")
+                self.connection.execute("CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT)")
+                self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)")
+                self.connection.execute("CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, "
+                                        "map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id")
+            else:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+                self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        self.__setMetadata("name", name)
+
+    @staticmethod
+    def getKey(tile):
+        # MBTiles rows use the TMS scheme, which counts Y up from the south instead of down from the north
+        return tile.zoom, tile.tileX, (1 << tile.zoom) - 1 - tile.tileY
+
+    def has(self, tile):
+        key = self.getKey(tile)
+        with self.lock:
+            if key in self.pending:
+                return True
+            row = self.connection.execute("SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", key).fetchone()
+        return row is not None
+
+    def open(self, tile):
+        return io.BytesIO(self.read(tile) or b"")
+
+    def stat(self, tile):
+        # Rows don't have a modification time, so only the size is compared
+        key = self.getKey(tile)
+        with self.lock:
+            if key in self.pending:
+                return len(self.pending[key]), None
+            row = self.connection.execute("SELECT length(tile_data) FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", key).fetchone()
+        return (row[0], None) if row else None
+
+    def read(self, tile):
+        key = self.getKey(tile)
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            row = self.connection.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", key).fetchone()
+        return bytes(row[0]) if row else None
+
+    def write(self, tile, data):
+        with self.lock:
+            if self.tileFormat is None and tile.tileExtension:
+                self.tileFormat = tile.tileExtension.lstrip(".").replace("jpeg", "jpg")
+                self.__setMetadata("format", self.tileFormat)
+            self.pending[self.getKey(tile)] = data
+            if len(self.pending) >= self.batchSize:
+                self.__flush()
+
+    def flush(self):
+        with self.lock:
+            self.__flush()
+
+    def close(self):
+        self.flush()
+        if self.dedup:
+            with self.connection:
+                self.connection.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+        self.connection.close()
+
+    def __flush(self):
+        if not self.pending:
+            return
+        with self.connection:
+            if self.dedup:
+                tileIds = {key: hashlib.sha1(data).hexdigest() for key, data in self.pending.items()}
+                self.connection.executemany("INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?)",
+                                            [(sqlite3.Binary(self.pending[key]), tileId) for key, tileId in tileIds.items()])
+                self.connection.executemany("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                                            [key + (tileId,) for key, tileId in tileIds.items()])
+            else:
+                self.connection.executemany("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                                            [key + (sqlite3.Binary(data),) for key, data in self.pending.items()])
+        self.pending.clear()
+
+    def __setMetadata(self, name, value):
+        with self.connection:
+            self.connection.execute("DELETE FROM metadata WHERE name = ?", (name,))
+            self.connection.execute("INSERT INTO metadata (name, value) VALUES (?, ?)", (name, value))
+
+
+def getServerKey(tileServer):
+    # A directory name for a tile server's tiles, readable but unique to its URL
+    host = re.sub(r"^\w+://", "", tileServer).split("/", 1)[0]
+    return re.sub(r"[^\w.-]", "_", host) + "_" + hashlib.sha1(tileServer.encode()).hexdigest()[:8]
+
+
+class CacheTileStore(FileTileStore):
+    # Loose files in a cache directory shared by every job, one subdirectory per tile server, bounded to maxSize
+    # bytes. When it grows past that, the least recently used tiles are evicted, going by an index of when each
+    # tile was last read or written (filesystem atimes are too often disabled to rely on). Tiles used since the run
+    # started are never evicted, the running job (or another store it opened, e.g. for another server) still needs them
+    # With evictOnFlush off, the cache is only trimmed when the store is closed, for runs that keep using their tiles
+    # after flushing them (anaxi batch)
+    # With dedup, hardlinked tiles are counted at their full size each, so the cache may hold less than maxSize
+    def __init__(self, cacheDir, tileServer, maxSize=0, dedup=False, evictOnFlush=True):
+        self.serverKey = getServerKey(tileServer)
+        FileTileStore.__init__(self, os.path.join(cacheDir, self.serverKey), dedup)
+        os.makedirs(self.root, exist_ok=True)
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.evictOnFlush = evictOnFlush
+        self.lock = threading.Lock()
+        self.indexLock = threading.Lock()  # One flush or eviction at a time, they share the connection
+        self.touched = {}  # File name to its size if we wrote it, or None if it was only read
+        self.sessionStarted = SESSION_STARTED
+        self.evicted = 0
+
+        self.connection = sqlite3.connect(os.path.join(cacheDir, "index.sqlite"), timeout=60, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS tiles (server TEXT, name TEXT, size INTEGER, accessed REAL, "
+                                    "PRIMARY KEY (server, name))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)")
+
+    def has(self, tile):
+        if not FileTileStore.has(self, tile):
+            return False
+        self.__touch(tile)
+        return True
+
+    def open(self, tile):
+        self.__touch(tile)
+        return FileTileStore.open(self, tile)
+
+    def read(self, tile):
+        data = FileTileStore.read(self, tile)
+        if data is not None:
+            self.__touch(tile)
+        return data
+
+    def write(self, tile, data):
+        FileTileStore.write(self, tile, data)
+        with self.lock:
+            self.touched[tile.getFileName()] = len(data)
+
+    def flush(self):
+        with self.indexLock:
+            self.__writeIndex()
+            if self.maxSize and self.evictOnFlush:
+                self.__evict()
+
+    def close(self):
+        with self.indexLock:
+            self.__writeIndex()
+            if self.maxSize:
+                self.__evict()
+        FileTileStore.close(self)
+        self.connection.close()
+        if self.evicted:
+            print("Evicted", self.evicted, "least recently used tiles from the tile cache")
+
+    def __writeIndex(self):
+        # Records when the tiles used since the last flush were accessed
+        with self.lock:
+            touched, self.touched = self.touched, {}
+        now = time.time()
+        rows = []
+        for name, size in touched.items():
+            if size is None:
+                try:
+                    size = os.path.getsize(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    continue
+            rows.append((self.serverKey, name, size, now))
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO tiles (server, name, size, accessed) VALUES (?, ?, ?, ?)", rows)
+
+    def __touch(self, tile):
+        with self.lock:
+            self.touched.setdefault(tile.getFileName(), None)
+
+    def __evict(self):
+        # Across every tile server in the cache, not just ours
+        with self.connection:
+            totalSize = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+            if totalSize <= self.maxSize:
+                return
+            evicted = []
+            for server, name, size in self.connection.execute("SELECT server, name, size FROM tiles WHERE accessed < ? ORDER BY accessed",
+                                                              (self.sessionStarted,)):
+                if totalSize <= self.maxSize:
+                    break
+                try:
+                    os.remove(os.path.join(self.cacheDir, server, name))
+                except FileNotFoundError:
+                    pass
+                evicted.append((server, name))
+                totalSize -= size
+            self.connection.executemany("DELETE FROM tiles WHERE server = ? AND name = ?", evicted)
+        self.evicted += len(evicted)
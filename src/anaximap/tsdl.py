@@ -1,22 +1,47 @@
 #!/usr/bin/python3
 # Anaximander Map Tile Downloader
 import argparse
+import bisect
+import collections
+import contextlib
+import functools
+import io
+import json
 import math
 import os
 import random
-import shutil
+import re
 import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from mimetypes import guess_extension
 
 import requests
 
+from . import shards
 from . import tilenames
+from . import tilestore
+from .journal import DownloadJournal
+from .manifest import TileManifest
+from .metrics import Metrics
+from .scheduler import READ_TIMEOUT, DownloadScheduler, getRequestTimeout, parseRetryAfter
+
+USER_AGENT = 'Anaxi Open Source Tile Stitch Software'
+
+# Load-balanced servers can be given as e.g. https://{a,b,c}.tile.openstreetmap.org/...
+SUBDOMAIN_PATTERN = re.compile(r"\{([^{}]*,[^{}]*)\}")
+DECODE_CACHE_SIZE = 256  # Decoded images of identical tiles kept around while stitching
 
 
 class AnaxiPreferences:
     def __init__(self, latStart, lonStart, latEnd, lonEnd, zoom, tileServer,
                  name="tiles", stitchFormat="", noStitch=False, interactive=True, forceDownload=False,
-                 dryRun=False):
+                 dryRun=False, concurrency=1, hostConcurrency=0, revalidate=False,
+                 tileStore="files", streamStitch=False, stitchWorkers=1, pyramidMinZoom=None, rateLimit=0, retries=3,
+                 journal=False, area=None, backgroundColor=None, dedup=False, verbose=False, metricsFile=None,
+                 prometheusFile=None, geotiff=False, cacheDir=None, cacheMaxSize=0, pipeline=False, scale=1.0, maxPixels=0,
+                 shard=None, mergeShards=0, timeout=READ_TIMEOUT):
         self.latStart = latStart
         self.lonStart = lonStart
         self.latEnd = latEnd
@@ -29,87 +54,294 @@ class AnaxiPreferences:
         self.interactive = interactive
         self.forceDownload = forceDownload
         self.dryRun = dryRun
+        self.concurrency = concurrency
+        self.hostConcurrency = hostConcurrency
+        self.revalidate = revalidate
+        self.tileStore = tileStore
+        self.streamStitch = streamStitch
+        self.stitchWorkers = stitchWorkers
+        self.pyramidMinZoom = pyramidMinZoom
+        self.rateLimit = rateLimit
+        self.retries = retries
+        self.journal = journal
+        self.area = area
+        self.backgroundColor = backgroundColor
+        self.dedup = dedup
+        self.verbose = verbose
+        self.metricsFile = metricsFile
+        self.prometheusFile = prometheusFile
+        self.geotiff = geotiff
+        self.cacheDir = os.path.abspath(cacheDir) if cacheDir else None  # We chdir while running
+        self.cacheMaxSize = cacheMaxSize  # MB, 0 for unlimited
+        self.pipeline = pipeline
+        self.scale = scale
+        self.maxPixels = maxPixels
+        self.shard = shard  # (i, N) to only download the i-th of N parts of the tiles
+        self.mergeShards = mergeShards
+        self.timeout = timeout
+
+
+class TileValidators:
+    # Remembers the ETag / Last-Modified of each cached tile, so it can be revalidated with a conditional request
+    def __init__(self, fileName="validators.json"):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.validators = {}
+        if os.path.isfile(fileName):
+            with open(fileName) as validatorsFile:
+                self.validators = json.load(validatorsFile)
+
+    def conditionalHeaders(self, tileName):
+        headers = {}
+        with self.lock:
+            tileValidators = self.validators.get(tileName, {})
+        if "etag" in tileValidators:
+            headers['If-None-Match'] = tileValidators["etag"]
+        if "lastModified" in tileValidators:
+            headers['If-Modified-Since'] = tileValidators["lastModified"]
+        return headers
+
+    def update(self, tileName, responseHeaders):
+        tileValidators = {}
+        if 'ETag' in responseHeaders:
+            tileValidators["etag"] = responseHeaders['ETag']
+        if 'Last-Modified' in responseHeaders:
+            tileValidators["lastModified"] = responseHeaders['Last-Modified']
+        with self.lock:
+            if tileValidators:
+                self.validators[tileName] = tileValidators
+            else:
+                self.validators.pop(tileName, None)
+
+    def save(self):
+        with self.lock:
+            with open(self.fileName + ".tmp", "w") as validatorsFile:
+                json.dump(self.validators, validatorsFile)
+        os.replace(self.fileName + ".tmp", self.fileName)
+
+
+class TileURLTemplate:
+    # A tile server URL parsed once into a format string, so making a tile's URL is a single str.format
+    def __init__(self, tileServer):
+        self.subdomains = []  # Choices for each {a,b,c} in the URL
+        formatString = ""
+        literalStart = 0
+        for match in SUBDOMAIN_PATTERN.finditer(tileServer):
+            formatString += self.__getFormatString(tileServer[literalStart:match.start()])
+            formatString += "{%d}" % (3 + len(self.subdomains))
+            self.subdomains.append(match.group(1).split(","))
+            literalStart = match.end()
+        formatString += self.__getFormatString(tileServer[literalStart:])
+        self.format = formatString.format
+
+    @staticmethod
+    def __getFormatString(literal):
+        return literal.replace("{", "{{").replace("}", "}}").replace("%zoom%", "{0}").replace("%xTile%", "{1}").replace("%yTile%", "{2}")
+
+    def getURL(self, zoom, x, y):
+        if not self.subdomains:
+            return self.format(zoom, x, y)
+        # Always the same subdomain for the same tile, so the server's caches stay useful
+        return self.format(zoom, x, y, *[subdomains[(x + y) % len(subdomains)] for subdomains in self.subdomains])
+
+
+@functools.lru_cache(maxsize=None)
+def getURLTemplate(tileServer):
+    return TileURLTemplate(tileServer)
 
 
 class Tile:
-    def __init__(self, zoom, x, y, tileServer):
+    # There can be millions of these in flight, so no per-instance __dict__
+    __slots__ = ("zoom", "tileX", "tileY", "tileServer", "store", "manifest", "tileExtension")
+
+    def __init__(self, zoom, x, y, tileServer, store=None, manifest=None, tileExtension=None):
         self.zoom = zoom
         self.tileX = x
         self.tileY = y
         self.tileServer = tileServer
+        self.store = store if store is not None else tilestore.FileTileStore()
+        self.manifest = manifest
+        self.tileExtension = tileExtension if tileExtension is not None else getFileExtension(tileServer)
 
-        self.tileServer = self.getProcessedURL()
-        self.tileExtension = getFileExtension(tileServer)
-
-    def download(self, forceDownload=False):
+    def download(self, forceDownload=False, scheduler=None, session=None, validators=None, metrics=None):
+        if metrics is None:
+            metrics = Metrics(verbose=True)
         fileName = self.getFileName()
+        url = self.getProcessedURL()
+        headers = {
+            'User-Agent': USER_AGENT
+        }
+
         if self.doesTileImageFileExist() and not forceDownload:
-            if self.isCorruptFile():
+            if self.manifest is not None and self.manifest.isGenerated(self):
+                metrics.log(fileName + " was built from the zoom below it, downloading the server's")
+            elif self.isCorruptFile():
                 print("Cached image possibly corrupt, downloading again")
+            elif validators is not None:
+                # Without any stored validators this is a full download, which gets us validators for next time
+                headers.update(validators.conditionalHeaders(fileName))
             else:
-                print("Skipping " + fileName + ", it already exists")
+                metrics.log("Skipping " + fileName + ", it already exists")
+                metrics.increment("tilesCached")
                 return 200
 
-        headers = {
-            'User-Agent': 'Anaxi Open Source Tile Stitch Software'
-        }
-
-        # Tweaked from https://stackoverflow.com/a/18043472/1709894
-        tileRequest = requests.get(self.tileServer, stream=True, headers=headers)
-        if tileRequest.status_code == 200:
+        attempt = 0
+        while True:
+            tileRequest = None
+            tileData = None
+            requestSlot = scheduler.forURL(url) if scheduler else contextlib.nullcontext()
+            with requestSlot:
+                requestStart = time.perf_counter()
+                try:
+                    # Tweaked from https://stackoverflow.com/a/18043472/1709894
+                    tileRequest = (session or requests).get(url, stream=True, headers=headers,
+                                                            timeout=scheduler.timeout if scheduler else getRequestTimeout())
+                    tileData = tileRequest.content
+                except requests.exceptions.RequestException as e:
+                    if scheduler is None:
+                        raise
+                    # A body that's cut off part way (e.g. ChunkedEncodingError) counts as a connection error too
+                    tileRequest = None
+                    requestError = e
+                metrics.observe("requestSeconds", time.perf_counter() - requestStart)
+
+            if scheduler is None:
+                break
+
+            statusCode = tileRequest.status_code if tileRequest is not None else None
+            retryAfter = parseRetryAfter(tileRequest.headers.get('Retry-After')) if tileRequest is not None else None
+            scheduler.report(url, statusCode, retryAfter)
+            if not scheduler.shouldRetry(statusCode, attempt):
+                break
+
+            backoff = scheduler.getBackoff(attempt, retryAfter)
+            metrics.log("Retrying", fileName, "in %.1fs" % backoff, "(" + (str(statusCode) if statusCode else str(requestError)) + ")")
+            metrics.increment("retries")
+            time.sleep(backoff)
+            attempt += 1
+
+        if tileRequest is None:
+            print("Error getting", fileName + ":", requestError)
+            metrics.increment("tilesFailed")
+            return 0
+
+        if tileRequest.status_code == 304:
+            metrics.log("Cached " + fileName + " is up to date")
+            metrics.increment("tilesNotModified")
+            return 200
+        elif tileRequest.status_code == 200:
+            metrics.increment("tilesDownloaded")
+            metrics.increment("bytesDownloaded", len(tileData))
             if not self.tileExtension:
                 self.tileExtension = guess_extension(tileRequest.headers['content-type'], strict=False)
                 if self.tileExtension == ".jpe":
                     # There is a bug in Python's Mimetypes library, fixed in later versions, that chooses .jpe for .jpg
                     # Despite .JPG being much more recognized
                     self.tileExtension = ".jpg"
-            with open(self.getFileName(), 'wb') as tileImageFile:
-                tileRequest.raw.decode_content = True
-                shutil.copyfileobj(tileRequest.raw, tileImageFile)
+            self.store.write(self, tileData)
+            if self.manifest is not None:
+                self.manifest.record(self, tileData, scanTileImage(io.BytesIO(tileData)))
+            if validators is not None:
+                validators.update(self.getFileName(), tileRequest.headers)
         else:
             print("Error getting", fileName + ":", tileRequest.reason, "(" + str(tileRequest.status_code) + ")")
+            metrics.increment("tilesFailed")
 
         return tileRequest.status_code
 
     def getProcessedURL(self):
-        return self.tileServer.replace("%zoom%", str(self.zoom)).replace("%xTile%", str(self.tileX)).replace("%yTile%", str(self.tileY))
+        return getURLTemplate(self.tileServer).getURL(self.zoom, self.tileX, self.tileY)
 
     def getFileName(self):
         return "%d_%d_%d%s" % (self.zoom, self.tileX, self.tileY, self.tileExtension)
 
     def doesTileImageFileExist(self):
-        return os.path.isfile(self.getFileName())
+        return self.store.has(self)
+
+    def openImage(self):
+        checkPilInstalled()  # Not imported yet if nothing was downloaded this run, e.g. when merging shards
+        return Image.open(self.store.open(self))
+
+    def getInfo(self, checkTransparency=False):
+        # Size, mode and transparency of the stored tile, or None if it can't be read. Answered from the manifest
+        # when the tile hasn't changed since it was last checked
+        tileInfo = self.manifest.lookup(self) if self.manifest is not None else None
+        if tileInfo is not None and not (checkTransparency and tileInfo["valid"] and tileInfo["transparency"] is None):
+            return tileInfo if tileInfo["valid"] else None
+        generated = tileInfo is not None and tileInfo.get("generated", False)
+
+        data = self.store.read(self)
+        if data is None:
+            return None
+        tileInfo = scanTileImage(io.BytesIO(data), checkTransparency)
+        if self.manifest is not None:
+            self.manifest.record(self, data, tileInfo, generated)
+        return tileInfo
 
     def isCorruptFile(self):
         if checkPilInstalled():
-            try:
-                Image.open(self.getFileName())
-            except OSError as e:
-                return True
+            return self.getInfo() is None
 
         return False  # assume not corrupt if PIL isn't installed
 
     def hasTransparency(self):
-        img = Image.open(self.getFileName())
-        # https://stackoverflow.com/a/58567453/1709894
-        if img.info.get("transparency", None) is not None:
-            return True
-        if img.mode == "P":
-            transparent = img.info.get("transparency", -1)
-            for _, index in img.getcolors():
-                if index == transparent:
-                    return True
-        elif img.mode == "RGBA":
-            extrema = img.getextrema()
-            if extrema[3][0] < 255:
-                return True
+        tileInfo = self.getInfo(checkTransparency=True)
+        return tileInfo is not None and tileInfo["transparency"]
+
+
+
+class TileSequence:
+    # The tiles of a TileCollection without keeping a Tile for each one. Tiles are numbered row by row (only counting
+    # the ones in the collection's cover, if it has one), and Tile objects are only made as they're used. Supports
+    # len(), iteration, indexing and slicing like a list
+    def __init__(self, collection, indices=None, runs=None):
+        self.collection = collection
+        self.runs = runs  # With a cover, (index of the first tile, y, startX) of every run of tiles
+        if self.runs is None and collection.cover is not None:
+            self.runs = []
+            numTiles = 0
+            for y in sorted(collection.cover.rows):
+                for startX, endX in collection.cover.rows[y]:
+                    self.runs.append((numTiles, y, startX))
+                    numTiles += endX - startX + 1
+        elif collection.cover is not None:
+            numTiles = None
+        else:
+            numTiles = (collection.tileEndX - collection.tileStartX + 1) * (collection.tileEndY - collection.tileStartY + 1)
+        self.indices = indices if indices is not None else range(numTiles)
+        self.runStarts = [run[0] for run in self.runs] if self.runs is not None else None
+
+    def getCoordsAt(self, index):
+        if self.runs is None:
+            width = self.collection.tileEndX - self.collection.tileStartX + 1
+            y, x = divmod(index, width)
+            return self.collection.tileStartX + x, self.collection.tileStartY + y
+
+        firstIndex, y, startX = self.runs[bisect.bisect_right(self.runStarts, index) - 1]
+        return startX + index - firstIndex, y
+
+    def getCoords(self):
+        # (x, y) of every tile, without making Tiles
+        for index in self.indices:
+            yield self.getCoordsAt(index)
+
+    def __len__(self):
+        return len(self.indices)
 
-        return False
+    def __iter__(self):
+        makeTile = self.collection.makeTile
+        for x, y in self.getCoords():
+            yield makeTile(x, y)
 
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return TileSequence(self.collection, self.indices[key], self.runs)
+        return self.collection.makeTile(*self.getCoordsAt(self.indices[key]))
 
 
 class TileCollection:
-    def __init__(self, tileStartX, tileStartY, tileEndX, tileEndY, zoom, tileServer, name):
+    def __init__(self, tileStartX, tileStartY, tileEndX, tileEndY, zoom, tileServer, name, store=None, manifest=None, cover=None,
+                 metrics=None, shard=None):
         self.tileServer = tileServer
         self.tileStartX = tileStartX
         self.tileStartY = tileStartY
@@ -117,45 +349,169 @@ class TileCollection:
         self.tileEndY = tileEndY
         self.zoom = zoom
         self.name = name
+        self.store = store if store is not None else tilestore.FileTileStore()
+        self.manifest = manifest
+        self.cover = cover  # Only download the tiles in this polygon.TileCover, instead of the whole rectangle
+        self.metrics = metrics if metrics is not None else Metrics(verbose=True)
+        self.tileExtension = getFileExtension(tileServer)  # Guessed from the first tile when the URL doesn't have one
+        self.session = None
+        self.scheduler = None
+
+        self.shard = shard  # (i, N) when only downloading the i-th of N parts of the tiles, see shards.py
+
+        self.tiles = TileSequence(self)
+        if shard is not None:
+            self.tiles = shards.getShardTiles(self.tiles, *shard)
+
+    def downloadTiles(self, forceDownload=False, concurrency=1, hostConcurrency=0, revalidate=False, rateLimit=0, retries=3,
+                      journal=None, onResult=None, timeout=READ_TIMEOUT):
+        # With onResult, it's called with (tile, status code) as each tile finishes, and failed tiles don't stop the
+        # download, they get a second pass at the end instead
+        if self.session is None:
+            self.session = newSession(concurrency)
+        self.scheduler = DownloadScheduler(hostConcurrency or concurrency, rateLimit, retries, timeout=timeout)
+        validators = TileValidators(shards.getShardFileName("validators.json", self.shard)) if revalidate else None
+        try:
+            with self.metrics.phase("download"):
+                self.__guessTileExtension(forceDownload, validators)
+                if journal is not None:
+                    return self.__downloadTilesJournaled(journal, forceDownload, concurrency, validators)
+                if onResult is not None:
+                    return self.__downloadTilesRetrying(forceDownload, concurrency, validators, onResult)
+                return self.__downloadEach(self.tiles, forceDownload, concurrency, validators, stopOnError=not forceDownload)
+        finally:
+            self.store.flush()
+            if self.manifest is not None:
+                self.manifest.save()
+            if validators is not None:
+                validators.save()
+
+    def makeTile(self, x, y):
+        return Tile(self.zoom, x, y, self.tileServer, self.store, self.manifest, self.tileExtension)
+
+    def __guessTileExtension(self, forceDownload, validators):
+        # Tiles are made as they're needed, so every tile gets the extension the first one was saved with
+        if not self.tileExtension and self.tiles:
+            tile = self.tiles[0]
+            tile.download(forceDownload, self.scheduler, self.session, validators, self.metrics)
+            print("Guessing future tile extensions will be", tile.tileExtension)
+            self.tileExtension = tile.tileExtension
 
-        self.tiles = []
-        self.__regenTiles()
+    def __downloadTilesJournaled(self, journal, forceDownload, concurrency, validators):
+        # Failures don't stop a journaled job, failed tiles get a second pass once everything else is done
+        if journal.open(self, restart=forceDownload):
+            print("Resuming from", journal.fileName + ",", len(journal.getPendingTiles()), "of", len(self.tiles), "tiles left to download")
 
-    def downloadTiles(self, forceDownload=False):
-        error = 0
-        if not getFileExtension(self.tileServer) and not forceDownload:
-            tile = self.tiles[0]
-            tile.download()
-            print("Guessing future tile extensions will be", tile.tileExtension + ". Pass --forceDownload to bypass")
-            newExt = tile.tileExtension
-            for tile in self.tiles:
-                # Regening the tiles with the new extension breaks some download URLs, and not doing so breaks cache.
-                # This is a happy medium, although a bit hacky
-                tile.tileExtension = newExt
-            #self.tileServer += tile.tileExtension
-            #self.__regenTiles()
+        try:
+            pendingTiles = [self.makeTile(x, y) for x, y in journal.getPendingTiles()]
+            self.__downloadEach(pendingTiles, forceDownload, concurrency, validators, stopOnError=False, onResult=journal.record)
+
+            failedTiles = journal.getFailedTiles()
+            if failedTiles:
+                print("Retrying", len(failedTiles), "failed tiles")
+                retryTiles = [self.makeTile(x, y) for x, y in failedTiles]
+                self.__downloadEach(retryTiles, forceDownload, concurrency, validators, stopOnError=False, onResult=journal.record)
+        finally:
+            journal.close()
+
+        failedTiles = journal.getFailedTiles()
+        if failedTiles:
+            print(len(failedTiles), "tiles could not be downloaded, run again to retry them (see", journal.fileName + ")")
+            return 1
+        return 0
+
+    def __downloadTilesRetrying(self, forceDownload, concurrency, validators, onResult):
+        failedTiles = []
 
+        def record(tile, downloadResult):
+            if downloadResult != 200:
+                failedTiles.append((tile.tileX, tile.tileY))
+            onResult(tile, downloadResult)
+
+        self.__downloadEach(self.tiles, forceDownload, concurrency, validators, stopOnError=False, onResult=record)
+        if failedTiles:
+            print("Retrying", len(failedTiles), "failed tiles")
+            retryTiles = [self.makeTile(x, y) for x, y in failedTiles]
+            failedTiles.clear()
+            self.__downloadEach(retryTiles, forceDownload, concurrency, validators, stopOnError=False, onResult=record)
+
+        if failedTiles:
+            print(len(failedTiles), "tiles could not be downloaded")
+            return 1
+        return 0
+
+    def __downloadEach(self, tiles, forceDownload, concurrency, validators, stopOnError, onResult=None):
+        self.metrics.startProgress("Downloading", len(tiles))
+        try:
+            if concurrency > 1:
+                return self.__downloadEachConcurrently(tiles, forceDownload, concurrency, validators, stopOnError, onResult)
+            return self.__downloadEachSerially(tiles, forceDownload, validators, stopOnError, onResult)
+        finally:
+            self.metrics.finishProgress()
+
+    def __downloadEachSerially(self, tiles, forceDownload, validators, stopOnError, onResult):
+        error = 0
         downloadedTiles = 0
-        for tile in self.tiles:
-            downloadResult = tile.download(forceDownload)
+        for tile in tiles:
+            downloadResult = tile.download(forceDownload, self.scheduler, self.session, validators, self.metrics)
             downloadedTiles += 1
-            print("Saving [" + str(downloadedTiles), "of", str(len(self.tiles)) + "]", tile.getProcessedURL(), "to", tile.getFileName())
+            self.metrics.log("Saving [" + str(downloadedTiles), "of", str(len(tiles)) + "]", tile.getProcessedURL(), "to", tile.getFileName())
+            self.metrics.advance()
+            if onResult is not None:
+                onResult(tile, downloadResult)
             if downloadResult != 200:
                 error = 1
-                if not forceDownload:
+                if stopOnError:
                     break
 
         return error
 
-    def __regenTiles(self):
-        self.tiles = []
-        for y in range(self.tileStartY, self.tileEndY + 1):
-            for x in range(self.tileStartX, self.tileEndX + 1):
-                self.tiles.append(Tile(self.zoom, x, y, self.tileServer))
+    def __downloadEachConcurrently(self, tiles, forceDownload, concurrency, validators, stopOnError, onResult):
+        error = 0
+        stopDownloading = threading.Event()
+
+        def downloadTile(tile):
+            if stopDownloading.is_set():
+                return None  # Another tile already failed, don't start new requests
+            return tile.download(forceDownload, self.scheduler, self.session, validators, self.metrics)
+
+        remainingTiles = iter(tiles)
+        inFlight = {}
+        downloadedTiles = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                # Only queue a couple of tiles per worker, so huge areas aren't all submitted up front
+                while len(inFlight) < concurrency * 2 and not stopDownloading.is_set():
+                    tile = next(remainingTiles, None)
+                    if tile is None:
+                        break
+                    inFlight[executor.submit(downloadTile, tile)] = tile
+
+                if not inFlight:
+                    break
+
+                done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tile = inFlight.pop(future)
+                    downloadResult = future.result()
+                    if downloadResult is None:
+                        continue
+
+                    downloadedTiles += 1
+                    self.metrics.log("Saving [" + str(downloadedTiles), "of", str(len(tiles)) + "]", tile.getProcessedURL(), "to", tile.getFileName())
+                    self.metrics.advance()
+                    if onResult is not None:
+                        onResult(tile, downloadResult)
+                    if downloadResult != 200:
+                        error = 1
+                        if stopOnError:
+                            stopDownloading.set()
+
+        return error
 
     def getMapName(self, stitchSaveFormat=""):
         if not stitchSaveFormat:
-            stitchSaveFormat = self.tiles[0].tileExtension
+            stitchSaveFormat = self.tileExtension
 
         stitchSaveFormat = stitchSaveFormat.strip()
 
@@ -164,52 +520,101 @@ class TileCollection:
 
         return "Map_{}_{}-{}_{}-{}{}".format(self.zoom, self.tileStartX, self.tileEndX, self.tileStartY, self.tileEndY, stitchSaveFormat)
 
-    def getMaxTileSize(self):
+    def getMercatorBounds(self):
+        # West, south, east and north edges of the Map in Web Mercator meters
+        south, west = tilenames.tileEdges(self.tileStartX, self.tileEndY, self.zoom)[:2]
+        north, east = tilenames.tileEdges(self.tileEndX, self.tileStartY, self.zoom)[2:]
+        return tilenames.latlon2meters(0, west)[0], tilenames.latlon2meters(south, 0)[1], \
+            tilenames.latlon2meters(0, east)[0], tilenames.latlon2meters(north, 0)[1]
+
+    def scanTiles(self):
+        # Opens every tile exactly once, redownloading any that can't be read, and works out how big the tiles are
+        # and whether the Map needs an alpha channel (based on the first tile)
+        with self.metrics.phase("validate"):
+            return self.__scanTiles()
+
+    def __scanTiles(self):
         maxXpx = 0
         maxYpx = 0
-        for tile in self.tiles:
-            tileImage = Image.open(tile.getFileName())
-            if tileImage.size[0] > maxXpx:
-                print("Changing tile width to {}".format(tileImage.size[0]))
-                maxXpx = tileImage.size[0]
+        transparency = False
+        for i, tile in enumerate(self.tiles):
+            tileInfo = tile.getInfo(checkTransparency=(i == 0))
+            if tileInfo is None:
+                print(tile.getFileName(), "may be corrupt, redownloading")
+                tile.download(forceDownload=True, scheduler=self.scheduler, session=self.session, metrics=self.metrics)
+                tileInfo = tile.getInfo(checkTransparency=(i == 0))
+                if tileInfo is None:
+                    print("Could not read", tile.getFileName() + ", it will be left blank")
+                    continue
 
-            if tileImage.size[1] > maxYpx:
-                print("Changing tile height to {}".format(tileImage.size[1]))
-                maxYpx = tileImage.size[1]
+            if i == 0:
+                transparency = tileInfo["transparency"]
 
-        return maxXpx, maxYpx
+            if tileInfo["size"][0] > maxXpx:
+                print("Changing tile width to {}".format(tileInfo["size"][0]))
+                maxXpx = tileInfo["size"][0]
 
-    def stitchImages(self, stitchSaveFormat=""):
-        if not checkPilInstalled():
-            print("ERROR: Stitching images requires the Pillow library")
-            return 10
+            if tileInfo["size"][1] > maxYpx:
+                print("Changing tile height to {}".format(tileInfo["size"][1]))
+                maxYpx = tileInfo["size"][1]
+        self.store.flush()
+        if self.manifest is not None:
+            self.manifest.save()
 
-        for tile in self.tiles:
-            if tile.isCorruptFile():
-                print(tile.getFileName(), "may be corrupt, redownloading")
-                tile.download(forceDownload=True)
+        return (maxXpx, maxYpx), transparency
 
-        tilePixelSize = self.getMaxTileSize()
+    def getMaxTileSize(self):
+        return self.scanTiles()[0]
+
+    def stitchImages(self, stitchSaveFormat="", streaming=False, workers=1, backgroundColor=None, geotiff=False, scale=1.0,
+                     maxPixels=0):
+        # Anywhere without a tile (outside a sparse cover, or unreadable) is filled with backgroundColor
+        # A geotiff is always streamed, and saved as a tiled, georeferenced .tif with overviews
+        # With a scale below 1 or a maxPixels, each tile is shrunk as it's decoded, so the full size Map never exists
+        if not checkPilInstalled():
+            print("ERROR: Stitching images requires the Pillow library")
+            return {'err': 10}
+
+        tilePixelSize, transparency = self.scanTiles()
+        scaledSize = getScaledTileSize(tilePixelSize, self.tileEndX - self.tileStartX + 1, self.tileEndY - self.tileStartY + 1,
+                                       scale, maxPixels)
+        if scaledSize != tilePixelSize:
+            print("Scaling tiles from %dx%d to %dx%d" % (tilePixelSize + scaledSize))
+            tilePixelSize = scaledSize
+        else:
+            scaledSize = None
 
         width = (abs((self.tileEndX - self.tileStartX)) + 1) * tilePixelSize[0]
         height = (abs((self.tileStartY - self.tileEndY)) + 1) * tilePixelSize[1]
 
         print("Canvas Size: %dw x %dh" % (width, height))
 
-        image = Image.new("RGB" + ("A" if self.tiles[0].hasTransparency() else ""), (width, height))
+        mode = "RGB" + ("A" if transparency else "")
+        if streaming or geotiff:
+            return self.__stitchImagesStreaming(stitchSaveFormat, mode, width, height, tilePixelSize, workers,
+                                                backgroundColor, geotiff, scaledSize)
+
+        image = Image.new(mode, (width, height), backgroundColor or 0)
 
         stitchedTiles = 0
-        for tile in self.tiles:
+        pasteSeconds = 0
+        self.metrics.startProgress("Stitching", len(self.tiles))
+        for tile, tileImage in self.metrics.timeEach("decode", self.decodeTiles(workers, scaledSize)):
             fileName = tile.getFileName()
 
             xPastePixel = (tile.tileX - self.tileStartX) * tilePixelSize[0]
             yPastePixel = (height - tilePixelSize[1]) - (self.tileEndY - tile.tileY) * tilePixelSize[1]
 
             stitchedTiles += 1
-            print("Stitching [" + str(stitchedTiles), "of", str(len(self.tiles)) + "]", fileName, "to %d, %d" % (xPastePixel, yPastePixel))
+            self.metrics.log("Stitching [" + str(stitchedTiles), "of", str(len(self.tiles)) + "]", fileName, "to %d, %d" % (xPastePixel, yPastePixel))
+            self.metrics.advance()
 
-            tileImage = Image.open(fileName)
-            image.paste(tileImage, (xPastePixel, yPastePixel))
+            if tileImage is not None:
+                pasteStart = time.perf_counter()
+                image.paste(tileImage, (xPastePixel, yPastePixel))
+                pasteSeconds += time.perf_counter() - pasteStart
+        self.metrics.finishProgress()
+        self.metrics.addTime("paste", pasteSeconds)
 
         image.info['tileStartX'] = self.tileStartX
         image.info['tileStartY'] = self.tileStartY
@@ -218,11 +623,192 @@ class TileCollection:
 
         stitchedImageName = self.getMapName(stitchSaveFormat)
         print("Saving to {}...".format(stitchedImageName))
-        image.save(stitchedImageName)
+        with self.metrics.phase("encode"):
+            image.save(stitchedImageName)
         print("Stitched image saved to {}".format(os.path.abspath(stitchedImageName)))
 
         return {'err': 0, 'image': image, 'imageName': stitchedImageName}
 
+    def __stitchImagesStreaming(self, stitchSaveFormat, mode, width, height, tilePixelSize, workers, backgroundColor,
+                                geotiff=False, scaledSize=None):
+        # Assembles and encodes one row of tiles at a time, so memory use scales with the Map's width, not its area
+        stitchedImageName, stripWriter = self.getStripWriter(stitchSaveFormat, geotiff)
+        if stripWriter is None:
+            return {'err': 11}
+
+        print("Saving to {}...".format(stitchedImageName))
+        stitchedTiles = 0
+        pasteSeconds = 0
+        encodeSeconds = 0
+        self.metrics.startProgress("Stitching", len(self.tiles))
+        decodedTiles = self.metrics.timeEach("decode", self.decodeTiles(workers, scaledSize))
+        nextDecoded = next(decodedTiles, None)
+        with stripWriter(stitchedImageName, width, height, mode) as writer:
+            # Every row needs a strip, even rows a sparse cover has no tiles in
+            for tileY in range(self.tileStartY, self.tileEndY + 1):
+                strip = Image.new(mode, (width, tilePixelSize[1]), backgroundColor or 0)
+                while nextDecoded is not None and nextDecoded[0].tileY == tileY:
+                    tile, tileImage = nextDecoded
+                    nextDecoded = next(decodedTiles, None)
+                    xPastePixel = (tile.tileX - self.tileStartX) * tilePixelSize[0]
+
+                    stitchedTiles += 1
+                    self.metrics.log("Stitching [" + str(stitchedTiles), "of", str(len(self.tiles)) + "]", tile.getFileName(), "to %d, %d" % (xPastePixel, (tileY - self.tileStartY) * tilePixelSize[1]))
+                    self.metrics.advance()
+
+                    if tileImage is not None:
+                        pasteStart = time.perf_counter()
+                        strip.paste(tileImage, (xPastePixel, 0))
+                        pasteSeconds += time.perf_counter() - pasteStart
+
+                encodeStart = time.perf_counter()
+                writer.writeStrip(strip)
+                encodeSeconds += time.perf_counter() - encodeStart
+        self.metrics.finishProgress()
+        self.metrics.addTime("paste", pasteSeconds)
+        self.metrics.addTime("encode", encodeSeconds)
+
+        print("Stitched image saved to {}".format(os.path.abspath(stitchedImageName)))
+
+        return {'err': 0, 'image': None, 'imageName': stitchedImageName}
+
+    def getStripWriter(self, stitchSaveFormat="", geotiff=False):
+        # (Map name, imagewriters class to stream it with), the class is None if the format can't be streamed
+        from . import imagewriters
+
+        if geotiff:
+            return self.getMapName(".tif"), functools.partial(imagewriters.GeoTiffStripWriter, bounds=self.getMercatorBounds())
+
+        if not stitchSaveFormat and self.tileExtension not in imagewriters.STRIP_WRITERS:
+            stitchSaveFormat = ".png"
+        stitchedImageName = self.getMapName(stitchSaveFormat)
+        stripWriter = imagewriters.STRIP_WRITERS.get(os.path.splitext(stitchedImageName)[1].lower())
+        if stripWriter is None:
+            print("ERROR: Streamed stitching only supports", ", ".join(imagewriters.STRIP_WRITERS), "output")
+        return stitchedImageName, stripWriter
+
+    def decodeTiles(self, workers=1, scaledSize=None):
+        # Yields (tile, decoded image) in tile order. With more than one worker, tiles are decoded in a process pool
+        # a little ahead of the caller, leaving only the paste to this process
+        # Tiles with identical contents (going by the manifest's hashes) are decoded once and share the image
+        decoded = collections.OrderedDict()  # Tile hash to its image (or Future), least recently used first
+        uniqueTiles = 0
+        with ProcessPoolExecutor(max_workers=workers) if workers > 1 else contextlib.nullcontext() as executor:
+            inFlight = collections.deque()
+            for tile in self.tiles:
+                tileHash = self.getTileHash(tile)
+                if tileHash in decoded:
+                    decoded.move_to_end(tileHash)
+                    tileImage = decoded[tileHash]
+                else:
+                    uniqueTiles += 1
+                    if executor is None:
+                        tileImage = decodeTileImage(tile.store.open(tile), scaledSize)
+                    else:
+                        tileImage = executor.submit(decodeTileImage, tile.store.open(tile), scaledSize)
+                    if tileHash is not None:
+                        decoded[tileHash] = tileImage
+                        if len(decoded) > DECODE_CACHE_SIZE:
+                            decoded.popitem(last=False)
+
+                inFlight.append((tile, tileImage))
+                if len(inFlight) >= workers * 4:
+                    tile, tileImage = inFlight.popleft()
+                    yield tile, tileImage.result() if isinstance(tileImage, Future) else tileImage
+
+            while inFlight:
+                tile, tileImage = inFlight.popleft()
+                yield tile, tileImage.result() if isinstance(tileImage, Future) else tileImage
+
+        self.metrics.increment("tilesDecoded", uniqueTiles)
+        if uniqueTiles < len(self.tiles):
+            self.metrics.log("Decoded", uniqueTiles, "unique tiles for", len(self.tiles), "tiles")
+
+    def getTileHash(self, tile):
+        # Hash of a tile's contents, or None if the manifest doesn't have an up to date one
+        if self.manifest is None:
+            return None
+        entry = self.manifest.lookup(tile)
+        return entry["sha1"] if entry is not None else None
+
+
+def newSession(poolSize=1):
+    # One keep-alive session per collection, so tiles don't each pay for a new TCP / TLS handshake
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def imageHasTransparency(img):
+    # https://stackoverflow.com/a/58567453/1709894
+    if img.info.get("transparency", None) is not None:
+        return True
+    if img.mode == "P":
+        transparent = img.info.get("transparency", -1)
+        for _, index in img.getcolors():
+            if index == transparent:
+                return True
+    elif img.mode == "RGBA":
+        extrema = img.getextrema()
+        if extrema[3][0] < 255:
+            return True
+
+    return False
+
+
+def scanTileImage(source, checkTransparency=False):
+    # Size, mode and transparency of a tile, from a single open. None if it can't be read
+    # Finding transparency in P / RGBA images means decoding them, so that is only done when asked for
+    checkPilInstalled()
+    try:
+        img = Image.open(source)
+        transparency = None
+        if checkTransparency or img.mode not in ("P", "RGBA"):
+            transparency = imageHasTransparency(img)
+    except OSError as e:
+        return None
+
+    return {"size": img.size, "mode": img.mode, "transparency": transparency}
+
+
+def decodeTileImage(source, scaledSize=None):
+    # Runs in stitch worker processes, so it must stay a module level function
+    # With scaledSize, the tile is shrunk to it. JPEGs are decoded straight to 1/2, 1/4 or 1/8 size where they can be
+    checkPilInstalled()
+    try:
+        img = Image.open(source)
+        if scaledSize is not None:
+            img.draft(img.mode, scaledSize)
+        img.load()
+    except OSError as e:
+        print("Could not decode tile:", e)
+        return None
+
+    if scaledSize is not None and img.size != scaledSize:
+        img = resizeTileImage(img, scaledSize)
+    return img
+
+
+def resizeTileImage(img, size):
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if img.mode in ("P", "LA", "PA") or "transparency" in img.info else "RGB")
+    if img.mode == "RGBA":
+        # Premultiplied, so transparent pixels don't bleed black into their neighbours
+        return img.convert("RGBa").resize(size, Image.LANCZOS).convert("RGBA")
+    return img.resize(size, Image.LANCZOS)
+
+
+def getScaledTileSize(tileSize, numTilesX, numTilesY, scale=1.0, maxPixels=0):
+    # Size to shrink every tile to so the Map is scale times its full size, and has no more than maxPixels pixels
+    fullPixels = tileSize[0] * numTilesX * tileSize[1] * numTilesY
+    if maxPixels and fullPixels * scale * scale > maxPixels:
+        scale = math.sqrt(maxPixels / fullPixels)
+    if scale >= 1:
+        return tileSize
+    return max(1, int(tileSize[0] * scale)), max(1, int(tileSize[1] * scale))
+
 
 def checkPilInstalled():
     installed = False
@@ -336,11 +922,89 @@ def commandLinePrefsParse():
     parser.add_argument('--forceDownload', action='store_true', help="Skip checking if files are already downloaded")
     parser.add_argument('--printSourcesAndExit', action='store_true', help="Print known tile sources and exit")  # Not handled by argparse
     parser.add_argument('--dryRun', action='store_true', help="Print download area, expected number of tiles and exit")
+    parser.add_argument('--concurrency', type=int, default=1, help="Number of tiles to download at once")
+    parser.add_argument('--hostConcurrency', type=int, default=0, help="Max concurrent downloads per tile server host (default: same as --concurrency)")
+    parser.add_argument('--rateLimit', type=float, default=0, help="Max requests per second to each host (default: unlimited, slowing down if the server pushes back)")
+    parser.add_argument('--retries', type=int, default=3, help="Times to retry a tile after a throttled / failed request")
+    parser.add_argument('--timeout', type=float, default=READ_TIMEOUT, help="Seconds a tile request may stall for before it's retried")
+    parser.add_argument('--journal', action='store_true', help="Keep a resumable journal of the download, and retry failed tiles instead of stopping")
+    parser.add_argument('--revalidate', action='store_true', help="Check cached tiles with the server (ETag / Last-Modified) and only download changed ones")
+    parser.add_argument('--tileStore', choices=["files", "mbtiles"], default="files", help="Keep tiles as loose files, or in a single MBTiles (SQLite) database")
+    parser.add_argument('--dedup', action='store_true', help="Store identical tiles only once (hardlinked files, or shared MBTiles images)")
+    parser.add_argument('--cacheDir', type=str, default=None, help="Keep tiles in this cache directory shared by every --name, instead of <name>/raw")
+    parser.add_argument('--cacheMaxSize', type=int, default=0, help="MB the shared cache may grow to before the least recently used tiles are evicted (default: unlimited)")
+    parser.add_argument('--streamStitch', action='store_true', help="Stitch one row of tiles at a time to limit memory use (PNG / TIFF output only)")
+    parser.add_argument('--geotiff', action='store_true', help="Save the Map as a Cloud Optimized GeoTIFF (georeferenced, tiled, with overviews)")
+    parser.add_argument('--stitchWorkers', type=int, default=1, help="Number of processes to decode tiles with while stitching")
+    parser.add_argument('--pipeline', action='store_true', help="Stitch tiles as they are downloaded, instead of after the whole download")
+    parser.add_argument('--scale', type=parseScale, default=1.0, help="Stitch the Map at this fraction of its full size, e.g. 0.25")
+    parser.add_argument('--maxPixels', type=parseMaxPixels, default=0, help="Shrink the stitched Map to at most this many pixels")
+    parser.add_argument('--area', type=str, default=None, help="GeoJSON file with a (Multi)Polygon, only tiles touching it (and inside the corners) are downloaded")
+    parser.add_argument('--backgroundColor', type=parseColor, default=None, help="Color to fill the Map with where there are no tiles, e.g. white or #e0e0e0")
+    parser.add_argument('--shard', type=shards.parseShard, default=None, help="Only download part i of N of the tiles (e.g. 2/4), sharing --name with the other parts")
+    parser.add_argument('--mergeShards', type=int, default=0, help="Stitch the Map once all N --shard parts of the download are done")
+    parser.add_argument('--pyramidMinZoom', type=int, default=None, help="Also build every zoom level down to this one from the downloaded tiles")
+    parser.add_argument('--verbose', action='store_true', help="Print a line for every tile instead of a progress bar")
+    parser.add_argument('--metricsFile', type=str, default=None, help="Append timings and counts for the run to this file as JSON Lines")
+    parser.add_argument('--prometheusFile', type=str, default=None, help="Keep a Prometheus textfile with the run's metrics up to date here")
 
     args = parser.parse_args()
     return AnaxiPreferences(args.latStart, args.lonStart, args.latEnd, args.lonEnd, args.zoom, args.tileServer,
                             args.name, args.stitchFormat, interactive=False, noStitch=args.noStitch,
-                            forceDownload=args.forceDownload, dryRun=args.dryRun)
+                            forceDownload=args.forceDownload, dryRun=args.dryRun,
+                            concurrency=args.concurrency, hostConcurrency=args.hostConcurrency,
+                            revalidate=args.revalidate, tileStore=args.tileStore,
+                            streamStitch=args.streamStitch, stitchWorkers=args.stitchWorkers,
+                            pyramidMinZoom=args.pyramidMinZoom, rateLimit=args.rateLimit, retries=args.retries,
+                            journal=args.journal, area=args.area, backgroundColor=args.backgroundColor,
+                            dedup=args.dedup, verbose=args.verbose, metricsFile=args.metricsFile,
+                            prometheusFile=args.prometheusFile, geotiff=args.geotiff, cacheDir=args.cacheDir,
+                            cacheMaxSize=args.cacheMaxSize, pipeline=args.pipeline, scale=args.scale,
+                            maxPixels=args.maxPixels, shard=args.shard, mergeShards=args.mergeShards,
+                            timeout=args.timeout)
+
+
+def resolveTileServer(tileServer):
+    # Tile servers can be given as the ID of one of the builtin sources
+    try:
+        tid = int(tileServer)
+        tileSource = getDefaultTileServers()[tid]
+
+        print("Using", tileSource[1], "as Tile Server Source")
+        printDefaultSourceData(tileSource)
+        tileServer = getDefaultTileServers()[tid][5]
+    except ValueError:
+        pass
+
+    if not getFileExtension(tileServer):
+        print("WARNING: The source you've given does not have a filetype extension. "
+              "We will do our best to guess, though this sometimes fails. \n")
+    return tileServer
+
+
+def parseColor(color):
+    # Checks a --backgroundColor (e.g. white or #e0e0e0) when it's given, rather than once everything is downloaded
+    from PIL import ImageColor
+    try:
+        ImageColor.getrgb(color)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return color
+
+
+def parseScale(scale):
+    # --scale only shrinks, a Map can't be stitched at 0 (or a negative) size
+    scale = float(scale)
+    if not 0 < scale <= 1:
+        raise argparse.ArgumentTypeError("scale must be more than 0 and at most 1, got %g" % scale)
+    return scale
+
+
+def parseMaxPixels(maxPixels):
+    maxPixels = int(maxPixels)
+    if maxPixels < 0:
+        raise argparse.ArgumentTypeError("maxPixels can't be negative, use 0 for no limit")
+    return maxPixels
 
 
 def getFileExtension(tileServerURL):
@@ -374,9 +1038,22 @@ def genInfoFile(tileCollection):
     print("cmd =", " ".join(sys.argv), file=infoFile)
 
 
-def processTileParams(prefs):
-    tileStartX, tileStartY = tilenames.tileXY(prefs.latStart, prefs.lonStart, prefs.zoom, True)
-    tileEndX, tileEndY = tilenames.tileXY(prefs.latEnd, prefs.lonEnd, prefs.zoom, True)
+def openTileStore(prefs):
+    # Tile stores are opened relative to the <name>/raw directory, unless they're in a shared cache
+    if prefs.cacheDir:
+        if prefs.tileStore == "mbtiles":
+            print("The shared tile cache keeps tiles as files, ignoring --tileStore mbtiles")
+        return tilestore.CacheTileStore(prefs.cacheDir, prefs.tileServer, prefs.cacheMaxSize * 1024 * 1024, prefs.dedup)
+    if prefs.tileStore == "mbtiles":
+        storeName = os.path.basename(os.path.normpath(prefs.name))
+        return tilestore.MBTilesTileStore(storeName + ".mbtiles", storeName, dedup=prefs.dedup)
+    return tilestore.FileTileStore(dedup=prefs.dedup)
+
+
+def getTileBounds(latStart, lonStart, latEnd, lonEnd, zoom):
+    # (tileStartX, tileStartY, tileEndX, tileEndY) of the tiles covering two corners, in either order
+    tileStartX, tileStartY = tilenames.tileXY(latStart, lonStart, zoom, True)
+    tileEndX, tileEndY = tilenames.tileXY(latEnd, lonEnd, zoom, True)
 
     # Sort the numbers low to high
     if tileStartY > tileEndY:
@@ -387,6 +1064,23 @@ def processTileParams(prefs):
 
     tileStartX, tileStartY = math.floor(tileStartX), math.floor(tileStartY)
     tileEndX, tileEndY = math.ceil(tileEndX), math.ceil(tileEndY)
+    return tileStartX, tileStartY, tileEndX, tileEndY
+
+
+def processTileParams(prefs):
+    tileStartX, tileStartY, tileEndX, tileEndY = getTileBounds(prefs.latStart, prefs.lonStart, prefs.latEnd, prefs.lonEnd, prefs.zoom)
+
+    cover = None
+    if prefs.area:
+        from . import polygon
+        boxTiles = (tileEndX - tileStartX + 1) * (tileEndY - tileStartY + 1)
+        cover = polygon.coverGeoJSON(polygon.loadGeoJSON(prefs.area), prefs.zoom).clip(tileStartX, tileStartY, tileEndX, tileEndY)
+        if not cover:
+            print("ERROR: The area in", prefs.area, "doesn't touch any tiles between the given corners")
+            return 1
+
+        tileStartX, tileStartY, tileEndX, tileEndY = cover.getBounds()
+        print("Area in", prefs.area, "touches", len(cover), "of the", boxTiles, "tiles between the corners")
 
     # S lat, W lon, N lat, E lon
     startCornerCoords = tilenames.tileEdges(tileStartX, tileStartY, prefs.zoom)
@@ -401,10 +1095,17 @@ def processTileParams(prefs):
     print("Downloading X tiles", tileStartX, "through", tileEndX)
     print("Downloading Y tiles", tileStartY, "through", tileEndY)
 
-    print("Downloading a total of", abs(tileEndX - tileStartX + 1) * abs(tileEndY - tileStartY + 1), "tiles")
+    print("Downloading a total of", len(cover) if cover is not None else abs(tileEndX - tileStartX + 1) * abs(tileEndY - tileStartY + 1), "tiles")
 
     print("Each tile at this zoom will be ~", str(tilenames.horozontalDistance(latStartCorner, prefs.zoom)), "meters wide")
 
+    if prefs.shard is not None:
+        if prefs.mergeShards:
+            print("ERROR: --shard and --mergeShards can't be used together, merge once every shard is done")
+            return 1
+        print("Downloading shard %d of %d," % prefs.shard, "the Map is stitched with --mergeShards %d" % prefs.shard[1])
+        prefs.noStitch = True
+
     if prefs.dryRun:
         try:
             checkPilInstalled()
@@ -414,32 +1115,82 @@ def processTileParams(prefs):
         print("Dry run, exiting now...")
         return 0
 
+    metrics = Metrics(prefs.metricsFile, prefs.prometheusFile, prefs.verbose)
+
     if not os.path.exists(prefs.name):
         os.mkdir(prefs.name)
 
     os.chdir(prefs.name)
 
-    tileCol = TileCollection(tileStartX, tileStartY, tileEndX, tileEndY, prefs.zoom, prefs.tileServer, prefs.name)
-
     if not os.path.exists("raw"):
         os.mkdir("raw")
 
     os.chdir("raw")
 
-    downloadErr = tileCol.downloadTiles(prefs.forceDownload)
-    if downloadErr == 0:
-        print("Download Complete!")
-        if not prefs.noStitch:
-            print("Stitching images...")
-            stitchResult = tileCol.stitchImages(prefs.stitchFormat)
-            if stitchResult["err"] == 0:
-                os.rename(stitchResult["imageName"], "../" + stitchResult["imageName"])
-                os.chdir("..")
-                return genInfoFile(tileCol)
+    tileStore = openTileStore(prefs)
+    tileCol = TileCollection(tileStartX, tileStartY, tileEndX, tileEndY, prefs.zoom, prefs.tileServer, prefs.name, tileStore,
+                             TileManifest(shards.getShardFileName("manifest.json", prefs.shard)), cover, metrics, prefs.shard)
+
+    pipelined = prefs.pipeline and not prefs.noStitch and not prefs.mergeShards
+    try:
+        if prefs.shard is not None:
+            shards.clearMarker(prefs.shard)
+        if prefs.mergeShards:
+            downloadErr = shards.mergeShards(tileCol, prefs.mergeShards)
+        elif pipelined:
+            from . import pipeline
+            if prefs.journal:
+                print("--pipeline retries failed tiles itself, ignoring --journal")
+            downloadErr = pipeline.downloadAndStitch(tileCol, prefs)
+        else:
+            downloadErr = tileCol.downloadTiles(prefs.forceDownload, prefs.concurrency, prefs.hostConcurrency, prefs.revalidate,
+                                                prefs.rateLimit, prefs.retries,
+                                                DownloadJournal(shards.getShardFileName("download.journal", prefs.shard)) if prefs.journal else None,
+                                                timeout=prefs.timeout)
+        metrics.printSummary()
+        if downloadErr == 0 and prefs.shard is not None:
+            # The pyramid is built from every shard's tiles, when merging
+            shards.writeMarker(tileCol)
+        elif downloadErr == 0:
+            print("Download Complete!")
+            tileCollections = [] if pipelined else [tileCol]
+            if prefs.pyramidMinZoom is not None and prefs.pyramidMinZoom < prefs.zoom:
+                from . import pyramid
+                tileCollections += pyramid.buildPyramid(tileCol, max(prefs.pyramidMinZoom, 0))
+
+            if not prefs.noStitch:
+                for stitchCol in tileCollections:
+                    stitchErr = stitchAndSave(stitchCol, prefs)
+                    if stitchErr != 0:
+                        return stitchErr
+    finally:
+        tileStore.close()
+        metrics.close()
 
     return downloadErr
 
 
+def stitchAndSave(tileCol, prefs):
+    # Stitches from inside <name>/raw, then moves the Map and its info file up into <name>
+    print("Stitching images...")
+    stitchResult = tileCol.stitchImages(prefs.stitchFormat, prefs.streamStitch, prefs.stitchWorkers, prefs.backgroundColor,
+                                        prefs.geotiff, prefs.scale, prefs.maxPixels)
+    return moveStitchedMap(tileCol, stitchResult)
+
+
+def moveStitchedMap(tileCol, stitchResult):
+    # Moves a Map stitched inside <name>/raw, and its info file, up into <name>
+    if stitchResult["err"] == 0:
+        os.rename(stitchResult["imageName"], "../" + stitchResult["imageName"])
+        os.chdir("..")
+        try:
+            genInfoFile(tileCol)
+        finally:
+            os.chdir("raw")
+
+    return stitchResult["err"]
+
+
 def main():
     print("Starting Anaxi Tile Downloader... \n")
 
@@ -448,23 +1199,19 @@ def main():
             printDefaultTileSources()
             exit(0)
 
+        if sys.argv[1] == "serve":
+            from . import server
+            return server.main(sys.argv[2:])
+
+        if sys.argv[1] == "batch":
+            from . import batch
+            return batch.main(sys.argv[2:])
+
         prefs = commandLinePrefsParse()
     else:
         prefs = interactivePromptPrefs()
 
-    try:
-        tid = int(prefs.tileServer)
-        tileSource = getDefaultTileServers()[tid]
-
-        print("Using", tileSource[1], "as Tile Server Source")
-        printDefaultSourceData(tileSource)
-        prefs.tileServer = getDefaultTileServers()[tid][5]
-    except ValueError:
-        pass
-
-    if not getFileExtension(prefs.tileServer):
-        print("WARNING: The source you've given does not have a filetype extension. "
-              "We will do our best to guess, though this sometimes fails. \n")
+    prefs.tileServer = resolveTileServer(prefs.tileServer)
 
     #prefs = AnaxiPreferences(latStart=42.363531, lonStart=-71.096362, latEnd=42.354185, lonEnd=-71.069741,
     #                                zoom=17, tileServer="https://c.tile.openstreetmap.org/%zoom%/%xTile%/%yTile%.png")